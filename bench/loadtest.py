@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load test for ASFMM, simulating a members meeting.
+
+Starts the service (from main.asfmm_app) in a separate process, with a throwaway database, a fake member roster
+and logins stubbed out, then opens a large number of /chat websockets and posts messages through /post at a steady
+rate. Reports connect and history replay times, delivery latency, and the CPU time and memory used by the service
+per connection, as JSON, so runs can be compared with each other:
+
+    python3 bench/loadtest.py --clients 2000 --rate 5 --duration 60 --output results.json
+
+CPU and memory figures are read from /proc, so are only available on Linux. Each websocket uses a file descriptor
+in both processes, so the open file limit (ulimit -n) needs to be well above the number of clients.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import aiohttp
+import aiohttp.web
+import yaml
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_MESSAGE = re.compile(r'"message":\s*"bench:([0-9.]+)"')  # Messages we posted carry the time they were sent
+
+
+def raise_file_limit():
+    """Raises the open file limit as far as we are allowed to, as every websocket needs a file descriptor"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def serve(port: int):
+    """Runs the service on localhost, trusting whatever user is named in the Authorization header"""
+    sys.path.insert(0, REPO_ROOT)
+    import asfquart.session
+    import hypercorn.asyncio
+    import hypercorn.config
+    import quart
+
+    async def read_session(*args, **kwargs):
+        for context in (quart.websocket, quart.request):
+            if context and context.headers.get("Authorization", "").startswith("Bearer "):
+                uid = context.headers["Authorization"][7:]
+                return asfquart.session.ClientSession({"uid": uid, "fullname": f"Bench User {uid}"})
+        return None
+
+    asfquart.session.read = read_session
+    import main
+
+    config = hypercorn.config.Config()
+    config.bind = [f"127.0.0.1:{port}"]
+    config.backlog = 4096
+    config.accesslog = None
+    raise_file_limit()
+    asyncio.run(hypercorn.asyncio.serve(main.app, config))
+
+
+def write_config(workdir: str, roster_url: str, members: list, rate: float):
+    """Sets up a working directory for the service: config, member roster cache and static files"""
+    with open(os.path.join(REPO_ROOT, "mm.yaml")) as f:
+        config = yaml.safe_load(f)
+    config["database"] = os.path.join(workdir, "asfmm.sqlite")
+    config["quorum"]["json_url"] = roster_url
+    config["quorum"]["cache_file"] = os.path.join(workdir, "members.json")
+    config["cluster"] = {"backend": "local"}
+    # Rate limits would only get in the way of measuring how the service copes with load
+    config["rate_limits"] = {"room": max(100, rate * 10), "user": 100, "burst": 100, "fanout": 10**9}
+    for channel in config["channels"].values():
+        channel.pop("rate_limits", None)
+    with open(os.path.join(workdir, "mm.yaml"), "w") as f:
+        yaml.safe_dump(config, f)
+    with open(config["quorum"]["cache_file"], "w") as f:
+        json.dump({"members": members}, f)
+    os.symlink(os.path.join(REPO_ROOT, "htdocs"), os.path.join(workdir, "htdocs"))
+
+
+async def start_roster(members: list) -> aiohttp.web.AppRunner:
+    """Serves a fake member roster, like the one on whimsy"""
+
+    async def roster(request):
+        if request.headers.get("If-None-Match") == '"bench"':
+            return aiohttp.web.Response(status=304)
+        return aiohttp.web.json_response({"members": members}, headers={"ETag": '"bench"'})
+
+    app = aiohttp.web.Application()
+    app.router.add_get("/", roster)
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    return runner
+
+
+def process_stats(pid: int) -> dict:
+    """Returns the CPU time (in seconds) and resident memory (in bytes) of a process, if /proc is available"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+    except (OSError, StopIteration):
+        return {"cpu": None, "rss": None}
+    return {"cpu": (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK"), "rss": rss}
+
+
+def percentiles(values: list) -> dict:
+    """Summarizes a list of durations (in seconds) as milliseconds"""
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pick(p):
+        return round(values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000, 3)
+
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values) * 1000, 3),
+        "p50": pick(50),
+        "p90": pick(90),
+        "p99": pick(99),
+        "max": round(values[-1] * 1000, 3),
+    }
+
+
+class Client:
+    """A simulated meeting attendee, keeping a websocket open and timing the messages it receives"""
+
+    def __init__(self, uid: str):
+        self.uid = uid
+        self.connect_time = None  # Time taken for the websocket handshake
+        self.replay_time = None  # Time taken until the history has been sent and the first presence update arrives
+        self.latencies = []  # Time between posting and receiving each benchmark message
+        self.error = None
+
+    async def run(self, session: aiohttp.ClientSession, url: str, connected: asyncio.Semaphore, stop: asyncio.Event):
+        headers = {"Authorization": f"Bearer {self.uid}"}
+        try:
+            async with connected:  # Limit the number of handshakes in flight
+                started = time.monotonic()
+                ws = await session.ws_connect(url, headers=headers, max_msg_size=0, autoping=True)
+                self.connect_time = time.monotonic() - started
+                async for message in ws:  # The first pong marks the end of the history replay
+                    if message.type == aiohttp.WSMsgType.TEXT and message.data.startswith('{"pong"'):
+                        self.replay_time = time.monotonic() - started
+                        break
+            receiver = asyncio.create_task(self.receive(ws))
+            await stop.wait()
+            receiver.cancel()
+            await ws.close()
+        except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+            self.error = str(e) or e.__class__.__name__
+
+    async def receive(self, ws: aiohttp.ClientWebSocketResponse):
+        async for message in ws:
+            if message.type == aiohttp.WSMsgType.TEXT:
+                for match in BENCH_MESSAGE.finditer(message.data):
+                    self.latencies.append(time.time() - float(match.group(1)))
+
+
+async def post_messages(session: aiohttp.ClientSession, url: str, users: list, rooms: list, rate: float, duration: float) -> dict:
+    """Posts messages at a steady rate, rotating between users and rooms"""
+    results = {"sent": 0, "refused": 0, "errors": 0, "latencies": []}
+    pending = set()
+
+    async def post(uid: str, room: str):
+        started = time.monotonic()
+        try:
+            async with session.post(url, json={"room": room, "message": f"bench:{time.time()}"}, headers={"Authorization": f"Bearer {uid}"}) as response:
+                answer = await response.json(content_type=None)
+                results["sent" if answer.get("success") else "refused"] += 1
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            results["errors"] += 1
+        results["latencies"].append(time.monotonic() - started)
+
+    started = time.monotonic()
+    count = 0
+    while (elapsed := time.monotonic() - started) < duration:
+        if count < elapsed * rate:
+            task = asyncio.create_task(post(users[count % len(users)], rooms[count % len(rooms)]))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            count += 1
+        else:
+            await asyncio.sleep(min(1 / rate, 0.01))
+    if pending:
+        await asyncio.wait(pending)
+    return results
+
+
+async def wait_for_server(session: aiohttp.ClientSession, url: str, server: subprocess.Popen, timeout: float = 60):
+    """Waits until the service answers HTTP requests"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Service exited with code {server.returncode}")
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.25)
+    raise RuntimeError("Service did not start in time")
+
+
+async def benchmark(args) -> dict:
+    raise_file_limit()
+    users = [f"bench{i:05d}" for i in range(args.clients)]
+    with socket.socket() as s:  # Find a free port for the service
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    roster = await start_roster(users)
+    roster_socket = socket.socket()
+    roster_socket.bind(("127.0.0.1", 0))
+    await aiohttp.web.SockSite(roster, roster_socket).start()
+    roster_url = "http://127.0.0.1:%d/" % roster_socket.getsockname()[1]
+
+    with tempfile.TemporaryDirectory(prefix="asfmm-bench-") as workdir:
+        write_config(workdir, roster_url, users, args.rate)
+        with open(os.path.join(workdir, "mm.yaml")) as f:
+            rooms = list(yaml.safe_load(f)["channels"].keys())
+        server = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--serve", str(port)],
+            cwd=workdir,
+            stdout=None if args.verbose else subprocess.DEVNULL,
+        )
+        base_url = f"http://127.0.0.1:{port}"
+        connector = aiohttp.TCPConnector(limit=0)
+        try:
+            async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None, connect=60)) as session:
+                await wait_for_server(session, base_url + "/", server)
+                idle = process_stats(server.pid)
+
+                # Everybody joins the meeting
+                clients = [Client(uid) for uid in users]
+                stop = asyncio.Event()
+                handshakes = asyncio.Semaphore(args.connect_concurrency)
+                started = time.monotonic()
+                tasks = [asyncio.create_task(client.run(session, f"ws://127.0.0.1:{port}/chat", handshakes, stop)) for client in clients]
+                while any(client.replay_time is None and client.error is None for client in clients):
+                    await asyncio.sleep(0.1)
+                join_time = time.monotonic() - started
+                joined = process_stats(server.pid)
+
+                # The meeting is under way
+                posting = await post_messages(session, base_url + "/post", users, rooms, args.rate, args.duration)
+                await asyncio.sleep(args.grace)  # Give the last messages time to arrive
+                busy = process_stats(server.pid)
+
+                stop.set()
+                await asyncio.gather(*tasks)
+        finally:
+            server.terminate()
+            server.wait()
+            await roster.cleanup()
+
+    connected = [client for client in clients if client.error is None]
+    latencies = [latency for client in connected for latency in client.latencies]
+    expected = posting["sent"] * len(connected)
+    results = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "parameters": {"clients": args.clients, "rate": args.rate, "duration": args.duration, "rooms": len(rooms)},
+        "clients": {
+            "connected": len(connected),
+            "failed": len(clients) - len(connected),
+            "errors": sorted({client.error for client in clients if client.error}),
+            "join_seconds": round(join_time, 3),
+        },
+        "connect_ms": percentiles([client.connect_time for client in connected]),
+        "history_replay_ms": percentiles([client.replay_time for client in connected if client.replay_time is not None]),
+        "posting": {
+            "sent": posting["sent"],
+            "refused": posting["refused"],
+            "errors": posting["errors"],
+            "post_ms": percentiles(posting["latencies"]),
+        },
+        "delivery": {
+            "received": len(latencies),
+            "expected": expected,
+            "lost": max(0, expected - len(latencies)),
+            "latency_ms": percentiles(latencies),
+        },
+        "server": {},
+    }
+    if idle["rss"] is not None:
+        results["server"] = {
+            "rss_idle_bytes": idle["rss"],
+            "rss_bytes": busy["rss"],
+            "rss_bytes_per_connection": round((joined["rss"] - idle["rss"]) / max(1, len(connected))),
+            "cpu_seconds_joining": round(joined["cpu"] - idle["cpu"], 3),
+            "cpu_seconds_meeting": round(busy["cpu"] - joined["cpu"], 3),
+            "cpu_ms_per_connection_per_second": round((busy["cpu"] - joined["cpu"]) * 1000 / max(1, len(connected)) / (args.duration + args.grace), 4),
+            "cpu_percent": round((busy["cpu"] - joined["cpu"]) * 100 / (args.duration + args.grace), 1),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for ASFMM, simulating a members meeting")
+    parser.add_argument("--clients", type=int, default=1500, help="Number of websocket clients (default: 1500)")
+    parser.add_argument("--rate", type=float, default=5, help="Messages posted per second, across all rooms (default: 5)")
+    parser.add_argument("--duration", type=float, default=60, help="How long to keep posting messages, in seconds (default: 60)")
+    parser.add_argument("--grace", type=float, default=5, help="How long to wait for the last messages to arrive, in seconds (default: 5)")
+    parser.add_argument("--connect-concurrency", type=int, default=100, help="Maximum number of websocket handshakes in flight (default: 100)")
+    parser.add_argument("--output", help="Write the results to this file instead of standard output")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the service")
+    parser.add_argument("--serve", type=int, metavar="PORT", help=argparse.SUPPRESS)  # Used to start the service itself
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve)
+        return
+    results = json.dumps(asyncio.run(benchmark(args)), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(results + "\n")
+    else:
+        print(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Memory benchmark for the in-memory chat history.
+
+Fills a throwaway database with chat messages from a realistic number of senders, and measures the memory used per
+message in a few ways: the messages as plain dicts (as rows used to be kept), as Message objects, and, most
+importantly, in a ChatRoom holding all of them, both loaded from the database at startup and appended one by one
+as they are posted. Prints the results as JSON:
+
+    python3 bench/memory.py --messages 100000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+import types
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import asfpy.sqlite  # noqa: E402
+import classes  # noqa: E402
+
+WORDS = "the members meeting vote board director proxy quorum ballot results apache foundation please thanks".split()
+ROOM = "asfmembers"
+
+
+def make_database(count: int, senders: int) -> asfpy.sqlite.DB:
+    """Creates an in-memory messages table with `count` messages in one room, posted by `senders` different people"""
+    db = asfpy.sqlite.DB(":memory:")
+    db.runc(classes.DB_CREATE_MESSAGES)
+    people = [(f"member{i:04d}", f"Member Number {i}") for i in range(senders)]
+    started = time.time() - count
+    rows = []
+    for i in range(count):
+        sender, realname = random.choice(people)
+        text = " ".join(random.choices(WORDS, k=random.randint(3, 20)))
+        rows.append((str(uuid.uuid4()), started + i, ROOM, sender, realname, text))
+    db.connector.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)", rows)
+    return db
+
+
+def measure(build) -> int:
+    """Returns the number of bytes still allocated after calling `build`, for as long as its result is kept"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    return used
+
+
+def room_state(db: asfpy.sqlite.DB, count: int):
+    """Returns just enough of a State for a ChatRoom, with its messages stored in db"""
+    return types.SimpleNamespace(
+        config={"history_size": count},
+        store=classes.SQLiteStore(db, None, ":memory:"),
+        metrics=types.SimpleNamespace(inc=lambda *args, **kwargs: None),
+        positions={},
+        broadcast=lambda *args, **kwargs: None,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory benchmark for the in-memory chat history")
+    parser.add_argument("--messages", type=int, default=100000, help="Number of messages (default: 100000)")
+    parser.add_argument("--senders", type=int, default=500, help="Number of different senders (default: 500)")
+    args = parser.parse_args()
+    random.seed(0)
+    db = make_database(args.messages, args.senders)
+    select = "SELECT * FROM messages ORDER BY timestamp"
+    as_dicts = measure(lambda: [dict(row) for row in db.connector.execute(select)])
+    as_messages = measure(lambda: [classes.Message.from_row(row) for row in db.connector.execute(select)])
+    loaded = measure(lambda: classes.ChatRoom(room_state(db, args.messages), ROOM, ROOM, ""))
+    empty = asfpy.sqlite.DB(":memory:")
+    room = classes.ChatRoom(room_state(empty, args.messages), ROOM, ROOM, "")
+
+    def post_all():
+        for row in db.connector.execute(select):
+            room.append(classes.Message.from_row(row))
+        return room
+
+    appended = measure(post_all)
+    print(
+        json.dumps(
+            {
+                "messages": args.messages,
+                "senders": args.senders,
+                "dict_bytes_per_message": round(as_dicts / args.messages, 1),
+                "message_bytes_per_message": round(as_messages / args.messages, 1),
+                "chatroom_loaded_bytes_per_message": round(loaded / args.messages, 1),
+                "chatroom_appended_bytes_per_message": round(appended / args.messages, 1),
+                "saved_percent": round(100 - max(loaded, appended) * 100 / as_dicts, 1),
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -17,12 +17,108 @@
 
 """Various classes in use by ASFMM"""
 
+import abc
+import array
+import asyncio
+import bisect
+import collections
+import fcntl
+import functools
+import heapq
+import math
+import mmap
+import queue
+import sqlite3
+import threading
 import time
 import typing
 import asfpy.sqlite
 import uuid
 import yaml
-import requests
+import aiohttp
+import gzip
+import hashlib
+import heapq
+import json
+import mimetypes
+import os
+import quart
+import random
+import re
+import struct
+import sys
+import traceback
+import zlib
+
+try:  # orjson encodes our broadcast frames considerably faster, but is optional
+    import orjson
+
+    def json_encode(obj) -> str:
+        """Encodes an object as a JSON string, using orjson"""
+        return orjson.dumps(obj).decode("utf-8")
+
+except ImportError:
+
+    def json_encode(obj) -> str:
+        """Encodes an object as a JSON string, using the standard json module"""
+        return json.dumps(obj)
+
+try:  # MessagePack makes for smaller websocket frames than JSON, but is optional
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:  # Brotli compresses static assets better than gzip, but is optional
+    import brotli
+except ImportError:
+    brotli = None
+
+WEBSOCKET_TIMEOUT = 10  # After 10 seconds of no activity, we consider someone signed out.
+PRESENCE_INTERVAL = 2.5  # Check presence and keep websockets alive every 2.5 seconds
+PRESENCE_RESEND = 3  # Send a (possibly empty) presence update every third presence check (7.5 seconds), as a keepalive
+PRESENCE_LOG_SIZE = 32  # Number of presence deltas to keep, for websockets that are a few updates behind
+HISTORY_CHUNK_SIZE = 250  # Number of messages sent per history frame when a client (re)connects
+DEFAULT_HISTORY_SIZE = 2000  # Number of recent messages per room to keep in memory, unless configured otherwise
+HISTORY_TIMESTAMP_STEP = 1e-6  # Smallest gap between the timestamps of two messages posted in a room by one worker
+DB_WRITER_BATCH_SIZE = 500  # Maximum number of queued writes to commit in a single transaction
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024  # Size at which a message log segment is sealed off, and a new one started
+LOG_INDEX_INTERVAL = 64  # Every this many records, a message log adds an entry to its sparse timestamp index
+LOG_RECORD_PREFIX = struct.Struct("<II")  # Message log records start with the payload length and a CRC32 of the rest
+LOG_RECORD_BODY = struct.Struct("<Bd16s")  # followed by the record type, timestamp and message key, then the payload
+LOG_RECORD_MESSAGE = 1  # Record type of a message, the payload is its encoded websocket frame
+LOG_RECORD_REDACTION = 2  # Record type of a redaction, the payload is the id of the redacted message
+ASSET_RECHECK_INTERVAL = 5  # How often (in seconds) to check whether static files have changed on disk
+FINGERPRINTED_ASSETS = ("/js/mm.js", "/css/mm.css")  # Served under checksummed URLs, and cached forever
+CLUSTER_BACKLOG_SIZE = 10000  # Maximum number of events to hold on to while reconnecting to the cluster hub
+CLUSTER_MAX_EVENT_SIZE = 4 * 1024 * 1024  # Largest event (in bytes) that can be passed between workers
+DEFAULT_INVITE_TTL = 86400  # Invite links are valid for a day, unless configured otherwise
+DEFAULT_INVITE_QUOTA = 25  # Maximum number of outstanding invites per member, unless configured otherwise
+DEFAULT_OUTBOX_SIZE = 1000  # Maximum number of frames waiting to be sent to a single websocket
+OUTBOX_POLICIES = ("drop_oldest", "coalesce", "disconnect")  # What to do when a websocket's outbox is full
+DEFAULT_RATE_LIMITS = {  # Used for any rate_limits setting that is not in mm.yaml
+    "room": 5,  # Messages per second per channel
+    "user": 1,  # Messages per second per user, per channel
+    "burst": 5,  # Number of messages a user can send in quick succession before being limited to the rate above
+    "fanout": 100000,  # Websocket deliveries per second, across all channels
+}
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+LOOP_LAG_INTERVAL = 1  # How often (in seconds) to measure how late the event loop is in running scheduled callbacks
+PROFILE_INTERVAL = 0.01  # Default time (in seconds) between stack samples taken by the profiler
+PROFILE_MAX_SECONDS = 120  # Longest a single profile can run for
+DEFAULT_SLOW_REQUEST = 2.0  # Log HTTP requests taking longer than this many seconds
+DEFAULT_SLOW_CALLBACK = 0.5  # Log event loop steps blocking the loop for longer than this many seconds
+TRACE_HEARTBEAT = 0.1  # How often (in seconds) the event loop checks in with the slow callback watchdog
+WIRE_PROTOCOLS = ("asfmm.msgpack", "asfmm.json")  # Websocket subprotocols we can speak, in order of preference
+PACKED_FRAME_CACHE_SIZE = 1024  # Number of frames to keep MessagePack versions of, for sending to many websockets
+# Short codes for field names in MessagePack frames. These need to match FIELD_NAMES in htdocs/js/mm.js
+FIELD_CODES = {
+    "msgid": "i", "timestamp": "t", "channel": "c", "sender": "s", "realname": "r", "message": "m", "history": "h",
+    "room_data": "d", "id": "n", "title": "T", "topic": "o", "redact": "R", "ack": "k", "success": "u", "gap": "g",
+    "pong": "p", "current": "C", "attendees": "a", "max": "x", "quorum": "q", "required": "Q",
+    "present": "P", "proxies": "y", "blocked": "b", "banned": "B", "moderation": "M", "version": "v", "delta": "D", "joined": "j",
+    "left": "l", "attended": "A", "proxied": "Y",
+}
+COMPRESSIBLE_TYPES = ("application/javascript", "application/json", "image/svg+xml", "application/vnd.ms-fontobject", "font/ttf", "font/otf")
 
 DB_CREATE_MESSAGES = """
 CREATE TABLE "messages" (
@@ -36,6 +132,10 @@ CREATE TABLE "messages" (
 );
 """
 
+DB_INDEX_MESSAGES = """
+CREATE INDEX IF NOT EXISTS "messages_room_timestamp" ON "messages" ("room", "timestamp");
+"""
+
 DB_CREATE_QUORUM = """
 CREATE TABLE "quorum" (
     "name" TEXT NOT NULL,
@@ -44,6 +144,52 @@ CREATE TABLE "quorum" (
 """
 
 
+DB_CREATE_INVITES = """
+CREATE TABLE "invites" (
+    "code"	TEXT NOT NULL,
+    "created"	REAL NOT NULL,
+    "expires"	REAL NOT NULL,
+    "inviter"	TEXT NOT NULL,
+    "inviter_name"	TEXT NOT NULL,
+    "name"	TEXT NOT NULL,
+    "guest_id"	INTEGER,
+    PRIMARY KEY("code")
+);
+"""
+
+DB_CREATE_MODERATION = """
+CREATE TABLE "moderation" (
+    "uid"	TEXT NOT NULL,
+    "status"	TEXT NOT NULL,
+    PRIMARY KEY("uid", "status")
+);
+"""
+
+# Full-text index of the messages table. It has no content of its own (it reads message text from the messages table
+# by rowid), and is kept in sync by triggers, so inserts and redactions through any connection update it.
+DB_CREATE_SEARCH = (
+    """CREATE VIRTUAL TABLE "messages_search" USING fts5(
+        "message", content="messages", content_rowid="rowid", tokenize="unicode61 remove_diacritics 2"
+    );""",
+    """CREATE TRIGGER "messages_search_insert" AFTER INSERT ON "messages" BEGIN
+        INSERT INTO "messages_search" ("rowid", "message") VALUES (new."rowid", new."message");
+    END;""",
+    """CREATE TRIGGER "messages_search_delete" AFTER DELETE ON "messages" BEGIN
+        INSERT INTO "messages_search" ("messages_search", "rowid", "message") VALUES ('delete', old."rowid", old."message");
+    END;""",
+    """CREATE TRIGGER "messages_search_update" AFTER UPDATE ON "messages" BEGIN
+        INSERT INTO "messages_search" ("messages_search", "rowid", "message") VALUES ('delete', old."rowid", old."message");
+        INSERT INTO "messages_search" ("rowid", "message") VALUES (new."rowid", new."message");
+    END;""",
+)
+
+DB_DROP_SEARCH = (
+    'DROP TRIGGER IF EXISTS "messages_search_insert";',
+    'DROP TRIGGER IF EXISTS "messages_search_delete";',
+    'DROP TRIGGER IF EXISTS "messages_search_update";',
+    'DROP TABLE IF EXISTS "messages_search";',
+)
+
 DB_CREATE_AUDIT = """
 CREATE TABLE "auditlog" (
     "uid"	TEXT NOT NULL,
@@ -53,9 +199,735 @@ CREATE TABLE "auditlog" (
 """
 
 
+def shorten_fields(obj):
+    """Replaces the field names in a decoded frame with their short codes"""
+    if isinstance(obj, dict):
+        return {FIELD_CODES.get(key, key): shorten_fields(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [shorten_fields(value) for value in obj]
+    return obj
+
+
+@functools.lru_cache(maxsize=PACKED_FRAME_CACHE_SIZE)
+def pack_frame(frame: str) -> bytes:
+    """Converts an encoded JSON frame to MessagePack with short field codes. Broadcast frames are the same string
+    for every websocket, so the result is cached, and only the first websocket to send a frame has to convert it."""
+    return msgpack.packb(shorten_fields(json.loads(frame)))
+
+
+def pack_id(msgid: str) -> typing.Union[bytes, str]:
+    """Packs a message id into the 16 bytes of its UUID. Ids that are not UUIDs are kept as they are."""
+    try:
+        packed = uuid.UUID(msgid)
+    except (ValueError, TypeError, AttributeError):
+        return msgid
+    return packed.bytes if str(packed) == msgid else msgid
+
+
+def unpack_id(packed: typing.Union[bytes, str]) -> str:
+    """Turns a packed message id back into its string form"""
+    return str(uuid.UUID(bytes=packed)) if isinstance(packed, bytes) else packed
+
+
+def message_key(msgid: str) -> bytes:
+    """Returns the 16 byte key of a message id, for looking messages up: its UUID, or a hash if it is not a UUID"""
+    packed = pack_id(msgid)
+    return packed if isinstance(packed, bytes) else hashlib.md5(packed.encode("utf-8")).digest()
+
+
+class Message:
+    """A chat message. Thousands of these are kept in memory, so they are kept small: no instance dict, sender,
+    realname and room strings shared between all messages (interned), and the id stored as 16 bytes."""
+
+    __slots__ = ("packed_id", "timestamp", "room", "sender", "realname", "text")
+
+    def __init__(self, msgid: str, timestamp: float, room: str, sender: str, realname: str, text: str):
+        self.packed_id = pack_id(msgid)
+        self.timestamp = timestamp
+        self.room = sys.intern(room)
+        self.sender = sys.intern(sender)
+        self.realname = sys.intern(realname)
+        self.text = text
+
+    @classmethod
+    def from_row(cls, row: typing.Mapping) -> "Message":
+        """Creates a message from a row in the messages table (or an equivalent dict)"""
+        return cls(row["uid"], row["timestamp"], row["room"], row["sender"], row["realname"], row["message"])
+
+    @classmethod
+    def from_frame(cls, frame: typing.Mapping) -> "Message":
+        """Creates a message from its (decoded) websocket representation"""
+        return cls(frame["msgid"], frame["timestamp"], frame["channel"], frame["sender"], frame["realname"], frame["message"])
+
+    @property
+    def msgid(self) -> str:
+        return unpack_id(self.packed_id)
+
+    def as_row(self) -> dict:
+        """Returns the message as a row for the messages table. This is also how it is passed between workers."""
+        return {
+            "uid": self.msgid,
+            "timestamp": self.timestamp,
+            "room": self.room,
+            "sender": self.sender,
+            "realname": self.realname,
+            "message": self.text,
+        }
+
+    def frame(self) -> dict:
+        """Returns the websocket representation of the message"""
+        return {
+            "msgid": self.msgid,
+            "timestamp": self.timestamp,
+            "channel": self.room,
+            "sender": self.sender,
+            "realname": self.realname,
+            "message": self.text,
+        }
+
+
+class Histogram:
+    """A Prometheus-style histogram: counts of observations at or below each bucket's upper bound"""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple = METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is the +Inf bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """A small registry of counters, gauges and histograms, rendered in the Prometheus text format.
+    Counters and histograms are updated in place on the hot path; gauges are callbacks, evaluated only when
+    the metrics are scraped."""
+
+    def __init__(self):
+        self.types = {}  # Metric name -> (type, help text)
+        self.counters = collections.defaultdict(float)  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.gauges = {}  # Metric name -> callback returning a value, or a dict of labels -> value
+
+    def describe(self, name: str, kind: str, text: str):
+        """Sets the type and help text of a metric"""
+        self.types[name] = (kind, text)
+
+    def inc(self, name: str, amount: float = 1, labels: tuple = ()):
+        """Increments a counter. Labels are given as a tuple of (key, value) pairs"""
+        self.counters[(name, labels)] += amount
+
+    def observe(self, name: str, value: float, labels: tuple = ()):
+        """Adds an observation to a histogram"""
+        histogram = self.histograms.get((name, labels))
+        if not histogram:
+            histogram = self.histograms[(name, labels)] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name: str, text: str, callback: typing.Callable, kind: str = "gauge"):
+        """Registers a gauge, whose value is fetched by calling the callback when the metrics are scraped.
+        Counters that are kept elsewhere can be exposed the same way, by setting kind to "counter"."""
+        self.describe(name, kind, text)
+        self.gauges[name] = callback
+
+    @staticmethod
+    def format_labels(labels: tuple, extra: tuple = ()) -> str:
+        """Formats (key, value) label pairs as {key="value",...}"""
+        labels = labels + extra
+        if not labels:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in labels)
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format"""
+        samples = collections.defaultdict(list)  # Metric name -> lines
+        for (name, labels), value in list(self.counters.items()):
+            samples[name].append(f"{name}{self.format_labels(labels)} {value}")
+        for (name, labels), histogram in list(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                samples[name].append(f"{name}_bucket{self.format_labels(labels, (('le', bound),))} {cumulative}")
+            samples[name].append(f"{name}_sum{self.format_labels(labels)} {histogram.sum}")
+            samples[name].append(f"{name}_count{self.format_labels(labels)} {histogram.count}")
+        for name, callback in self.gauges.items():
+            value = callback()
+            if isinstance(value, dict):
+                for labels, labelled_value in value.items():
+                    samples[name].append(f"{name}{self.format_labels(labels)} {labelled_value}")
+            else:
+                samples[name].append(f"{name} {value}")
+        lines = []
+        for name in sorted(samples):
+            if name in self.types:
+                kind, text = self.types[name]
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples[name])
+        return "\n".join(lines) + "\n"
+
+    async def run(self):
+        """Measures event loop lag: how much later than scheduled a sleeping task gets to run again"""
+        loop = asyncio.get_running_loop()
+        while True:
+            scheduled = loop.time() + LOOP_LAG_INTERVAL
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.observe("asfmm_event_loop_lag_seconds", max(0.0, loop.time() - scheduled))
+
+
+class Fanout:
+    """Tracks the delivery of a broadcast frame to all websockets, recording how long it took to reach the last one"""
+
+    __slots__ = ("metrics", "started", "pending")
+
+    def __init__(self, metrics: Metrics, pending: int):
+        self.metrics = metrics
+        self.started = time.monotonic()
+        self.pending = pending
+
+    def done(self):
+        """Marks the frame as sent to (or dropped for) one more websocket"""
+        self.pending -= 1
+        if self.pending == 0:
+            self.metrics.observe("asfmm_fanout_seconds", time.monotonic() - self.started)
+
+
+class DBWriter:
+    """Write-behind persistence. Writes are queued up by the caller and committed by a background thread
+    in batched transactions, so a slow disk never holds up the event loop."""
+
+    def __init__(self, db_name: str, metrics: Metrics = None):
+        self.db_name = db_name
+        self.metrics = metrics
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="DBWriter", daemon=True)
+        self.thread.start()
+
+    def insert(self, table: str, document: dict):
+        """Queues a row to be inserted into a table"""
+        columns = ", ".join("`%s`" % key for key in document.keys())
+        questionmarks = ", ".join(["?"] * len(document))
+        self.queue.put((f"INSERT INTO {table} ({columns}) VALUES ({questionmarks});", list(document.values()), False))
+
+    def delete(self, table: str, **target):
+        """Queues a deletion of all rows in a table matching the target key/value pairs"""
+        search = " AND ".join("`%s` = ?" % key for key in target.keys())
+        self.queue.put((f"DELETE FROM {table} WHERE {search};", list(target.values()), False))
+
+    def execute(self, statement: str, *args):
+        """Queues an arbitrary SQL statement"""
+        self.queue.put((statement, list(args), False))
+
+    def executemany(self, statement: str, rows: typing.Iterable[typing.Sequence]):
+        """Queues an SQL statement to be run once for every row of arguments, in the same transaction"""
+        self.queue.put((statement, list(rows), True))
+
+    def call(self, function: typing.Callable, *args):
+        """Queues a function to be called on the writer thread, after the writes queued before it. Used for writes
+        that are not SQL, so they don't hold up the event loop either."""
+        self.queue.put((functools.partial(function, *args), None, False))
+
+    async def flush(self):
+        """Waits until everything queued so far has been committed to disk"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def done():
+            if not future.done():
+                future.set_result(True)
+
+        self.queue.put((lambda: loop.call_soon_threadsafe(done), None, False))
+        await future
+
+    def close(self):
+        """Commits everything still in the queue and stops the writer thread"""
+        self.queue.put(None)
+        self.thread.join()
+
+    @staticmethod
+    def write(db: asfpy.sqlite.DB, statement: str, args: list, many: bool):
+        """Runs a single queued statement"""
+        if many:
+            db.cursor.executemany(statement, args)
+        else:
+            db.run(statement, *args)
+
+    def run(self):
+        """Writer thread: waits for writes, and commits whatever has queued up in a single transaction"""
+        db = asfpy.sqlite.DB(self.db_name)
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < DB_WRITER_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            statements = [item for item in batch if item and not callable(item[0])]
+            if statements:
+                started = time.monotonic()
+                try:
+                    db.run("BEGIN")
+                    for statement, args, many in statements:
+                        self.write(db, statement, args, many)
+                    db.run("COMMIT")
+                except sqlite3.Error as e:  # Don't lose the whole batch over a single bad write, retry one by one
+                    print(f"Could not commit batch of {len(statements)} write(s), retrying individually: {e}")
+                    db.connector.rollback()
+                    for statement, args, many in statements:
+                        try:
+                            db.run("BEGIN")
+                            self.write(db, statement, args, many)
+                            db.run("COMMIT")
+                        except sqlite3.Error as e:
+                            db.connector.rollback()
+                            print(f"Could not write to database: {e} ({statement})")
+                if self.metrics:
+                    self.metrics.observe("asfmm_db_write_seconds", time.monotonic() - started)
+                    self.metrics.inc("asfmm_db_writes_total", sum(len(args) if many else 1 for _, args, many in statements))
+            for item in batch:
+                if item is None:  # Closing down
+                    return
+                if callable(item[0]):  # Flush barrier, or a queued call
+                    try:
+                        item[0]()
+                    except Exception as e:  # Keep the writer going for everyone else
+                        print(f"Queued call on the writer thread failed: {e}")
+                        traceback.print_exc()
+
+
+class EventBus:
+    """In-process event bus. All changes to shared state (messages, presence, moderation, invites) are published
+    as events, and applied by the handlers subscribed to them. With a single worker, this is all there is."""
+
+    def __init__(self):
+        self.handlers: dict = collections.defaultdict(list)  # event type -> list of handlers
+
+    def subscribe(self, event: str, handler: typing.Callable):
+        """Registers a handler for a type of event. Handlers are called with the event data as their only argument."""
+        self.handlers[event].append(handler)
+
+    def dispatch(self, event: str, data: typing.Any):
+        """Calls all local handlers for an event"""
+        for handler in self.handlers[event]:
+            handler(data)
+
+    def publish(self, event: str, data: typing.Any, local: bool = True):
+        """Publishes an event. Set local to False for events that have already been applied in this worker,
+        and only need to reach other workers."""
+        if local:
+            self.dispatch(event, data)
+
+    async def run(self):
+        """Nothing to run for the in-process bus"""
+        pass
+
+
+class UnixSocketBus(EventBus):
+    """Event bus shared by several worker processes on the same host, through a Unix socket.
+    Whichever worker holds the lock file runs the hub, which relays every event to all other workers.
+    If the hub goes away, the remaining workers reconnect, and one of them takes over as the hub."""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.lock_file = None
+        self.hub = None
+        self.hub_clients: set = set()
+        self.writer: typing.Optional[asyncio.StreamWriter] = None
+        self.backlog = collections.deque(maxlen=CLUSTER_BACKLOG_SIZE)  # Events published while disconnected
+
+    def publish(self, event: str, data: typing.Any, local: bool = True):
+        if local:
+            self.dispatch(event, data)
+        line = (json_encode({"event": event, "data": data}) + "\n").encode("utf-8")
+        if self.writer:
+            self.writer.write(line)
+        else:
+            self.backlog.append(line)
+
+    def try_lock(self) -> bool:
+        """Tries to grab the hub lock. The OS releases it if the process holding it dies."""
+        if self.lock_file:
+            return True
+        lock_file = open(self.path + ".lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    async def relay(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Hub side: relays every event from one worker to all the others"""
+        self.hub_clients.add(writer)
+        try:
+            while line := await reader.readline():
+                for client in list(self.hub_clients):
+                    if client is not writer:
+                        client.write(line)
+                        await client.drain()
+        except (ConnectionError, asyncio.CancelledError):  # Worker went away, or we are shutting down
+            pass
+        finally:
+            self.hub_clients.discard(writer)
+            writer.close()
+
+    async def run(self):
+        """Connects to the hub (starting it first, if nobody else is running it), and applies all incoming events"""
+        while True:
+            try:
+                if not self.hub and self.try_lock():
+                    self.hub = await asyncio.start_unix_server(self.relay, path=self.path, limit=CLUSTER_MAX_EVENT_SIZE)
+                    print(f"Running cluster event hub on {self.path}")
+                reader, self.writer = await asyncio.open_unix_connection(self.path, limit=CLUSTER_MAX_EVENT_SIZE)
+                while self.backlog:
+                    self.writer.write(self.backlog.popleft())
+                while line := await reader.readline():
+                    event = json.loads(line)
+                    self.dispatch(event["event"], event["data"])
+            except (OSError, ValueError) as e:
+                print(f"Lost connection to cluster event hub: {e}")
+            self.writer = None
+            await asyncio.sleep(random.uniform(0.1, 1))  # Don't have every worker race for the hub at the same time
+
+
+class Profiler:
+    """A sampling profiler for the live process. A separate thread takes a sample of the stacks of all other threads
+    at a fixed interval, and counts them in collapsed form: one line per unique stack, from the thread down to the
+    innermost function, separated by semicolons, followed by the number of samples. Tools like flamegraph.pl and
+    speedscope read this as-is. Only one profile can be taken at a time."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def collapse(thread: str, frame) -> str:
+        """Returns a stack in collapsed form, outermost frame first"""
+        frames = []
+        while frame:
+            code = frame.f_code
+            frames.append(f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}")
+            frame = frame.f_back
+        frames.append(thread.replace(";", ":").replace(" ", "_"))
+        return ";".join(reversed(frames))
+
+    def profile(self, seconds: float, interval: float = PROFILE_INTERVAL) -> str:
+        """Samples all threads for a number of seconds, and returns the collapsed stacks. This blocks for the duration,
+        so should be run in a thread of its own."""
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError("A profile is already being taken, please try again later")
+        try:
+            samples = collections.Counter()
+            me = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident != me:
+                        samples[self.collapse(names.get(ident, str(ident)), frame)] += 1
+                time.sleep(interval)
+        finally:
+            self.lock.release()
+        return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+
+class Tracer:
+    """Logs slow HTTP requests, and event loop steps (callbacks and task steps) that block the loop for too long.
+    The event loop checks in with a watchdog thread every TRACE_HEARTBEAT seconds. If it fails to, the watchdog logs
+    the stack the loop is stuck in, and how long it was stuck once it gets going again. Thresholds are in seconds,
+    and can be changed at runtime through the event bus, so every worker picks them up. 0 turns a check off."""
+
+    def __init__(self, bus: EventBus, slow_request: float = DEFAULT_SLOW_REQUEST, slow_callback: float = DEFAULT_SLOW_CALLBACK):
+        self.bus = bus
+        self.bus.subscribe("tracing", self.apply)
+        self.slow_request = slow_request
+        self.slow_callback = slow_callback
+        self.heartbeat = time.monotonic()
+        self.loop_thread = None  # Thread id of the event loop, while it is being watched
+
+    def configure(self, **thresholds):
+        """Changes thresholds in every worker"""
+        for name, value in thresholds.items():
+            if name not in ("slow_request", "slow_callback") or not isinstance(value, (int, float)) or value < 0:
+                raise ValueError(f"Invalid tracing threshold: {name}={value!r}")
+        self.bus.publish("tracing", thresholds)
+
+    def apply(self, thresholds: dict):
+        for name, value in thresholds.items():
+            setattr(self, name, value)
+        print(f"Tracing thresholds set: slow requests {self.slow_request}s, slow callbacks {self.slow_callback}s")
+
+    def request(self, method: str, path: str, duration: float):
+        """Logs a request if it took too long"""
+        if self.slow_request and duration >= self.slow_request:
+            print(f"Slow request: {method} {path} took {duration:.3f}s")
+
+    def watch(self):
+        """Watchdog thread, logs when the event loop fails to check in"""
+        reported = None  # Heartbeat we last logged a stall after
+        while self.loop_thread:
+            time.sleep(TRACE_HEARTBEAT)
+            heartbeat = self.heartbeat
+            if reported is not None and heartbeat != reported:
+                print(f"Event loop was blocked for about {heartbeat - reported - TRACE_HEARTBEAT:.3f}s")
+                reported = None
+            stalled = time.monotonic() - heartbeat - TRACE_HEARTBEAT
+            if self.slow_callback and stalled >= self.slow_callback and reported is None:
+                reported = heartbeat
+                frame = sys._current_frames().get(self.loop_thread)
+                stack = "".join(traceback.format_stack(frame)) if frame else ""
+                print(f"Event loop blocked for over {stalled:.3f}s, in:\n{stack}", end="")
+
+    async def run(self):
+        """Checks in with the watchdog thread for as long as the event loop runs"""
+        self.loop_thread = threading.get_ident()
+        threading.Thread(target=self.watch, name="asfmm-watchdog", daemon=True).start()
+        try:
+            while True:
+                self.heartbeat = time.monotonic()
+                await asyncio.sleep(TRACE_HEARTBEAT)
+        finally:
+            self.loop_thread = None
+
+
+class Outbox:
+    """A bounded queue of frames waiting to be sent to a single websocket. If a client cannot keep up, frames are
+    dropped according to the policy:
+    - drop_oldest: the oldest frame is dropped to make room for the new one
+    - coalesce: all queued chat frames are dropped at once, as a resync fetches them again. Snapshots (frames holding
+      all of some state, like the moderation lists) are kept, and a newer one replaces any queued one of its kind.
+    - disconnect: the backlog is dropped and the websocket task is cancelled
+    If nothing can be dropped, the websocket is disconnected. When frames have been dropped, the client is sent
+    a gap notice before the next frame, so it knows to resync."""
+
+    def __init__(self, size: int = DEFAULT_OUTBOX_SIZE, policy: str = "drop_oldest", task: asyncio.Task = None, uid: str = None):
+        if policy not in OUTBOX_POLICIES:
+            raise ValueError(f"Unknown outbox policy: {policy}")
+        self.size = size
+        self.policy = policy
+        self.task = task
+        self.uid = uid  # The user the websocket belongs to
+        self.frames = collections.deque()
+        self.ready = asyncio.Event()
+        self.gap = 0  # Number of frames dropped since the last gap notice
+        self.dropped = 0  # Total number of frames dropped
+        self.peak = 0  # Highest queue depth seen
+        self.closed = None  # Why the websocket is being disconnected: "slow" (could not keep up) or "banned"
+        self.sending = None  # Fanout of the frame currently being sent, if it is being tracked
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame: str, fanout: Fanout = None, snapshot: str = None):
+        """Queues up a frame for sending, dropping older frames if the outbox is full. If the frame is a snapshot,
+        snapshot names the kind of state it holds."""
+        if self.closed:
+            if fanout:
+                fanout.done()
+            return
+        if snapshot and self.policy == "coalesce":  # Only the latest snapshot of a kind needs to be sent
+            stale = next((entry for entry in self.frames if entry[2] == snapshot), None)
+            if stale:
+                self.frames.remove(stale)
+        if len(self.frames) >= self.size:
+            if self.policy == "drop_oldest":
+                self.discard(1)
+                self.gap += 1
+            elif self.policy == "coalesce":
+                self.coalesce()
+            if len(self.frames) >= self.size:  # Disconnect policy, or nothing left to drop
+                self.dropped += 1
+                if fanout:
+                    fanout.done()
+                self.close("slow")
+                return
+        self.frames.append((frame, fanout, snapshot))
+        self.peak = max(self.peak, len(self.frames))
+        self.ready.set()
+
+    def close(self, reason: str):
+        """Drops the backlog and disconnects the websocket"""
+        if self.closed:
+            return
+        self.discard()
+        self.closed = reason
+        self.ready.set()
+        if self.task:  # The task may well be stuck sending, so cancel it rather than wait for it
+            self.task.cancel()
+
+    def discard(self, count: int = 0):
+        """Drops the oldest `count` frames, or all of them if count is 0"""
+        for _ in range(count or len(self.frames)):
+            _, fanout, _ = self.frames.popleft()
+            if fanout:
+                fanout.done()
+            self.dropped += 1
+
+    def coalesce(self):
+        """Drops all queued chat frames, keeping the snapshots"""
+        kept = collections.deque()
+        for entry in self.frames:
+            if entry[2]:
+                kept.append(entry)
+                continue
+            if entry[1]:
+                entry[1].done()
+            self.dropped += 1
+            self.gap += 1
+        self.frames = kept
+
+    def get_nowait(self) -> typing.Optional[str]:
+        """Returns the next frame to send, or None if there is nothing to send"""
+        self.sent()
+        if self.closed:
+            return None
+        if self.gap:
+            frame = json_encode({"gap": self.gap})
+            self.gap = 0
+            return frame
+        if self.frames:
+            frame, self.sending, _ = self.frames.popleft()
+            return frame
+        self.ready.clear()
+        return None
+
+    def sent(self):
+        """Marks the last frame returned by get() as sent"""
+        if self.sending:
+            self.sending.done()
+            self.sending = None
+
+    async def get(self) -> typing.Optional[str]:
+        """Waits for the next frame to send. Returns None if the websocket is being disconnected"""
+        while (frame := self.get_nowait()) is None and not self.closed:
+            await self.ready.wait()
+        return frame
+
+
+class TokenBucket:
+    """A token bucket, refilled lazily whenever it is checked. Holds up to burst tokens, adding rate tokens per second"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> float:
+        """Adds the tokens accrued since the last check, and returns the number of tokens available"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def allows(self, now: float, cost: float = 1) -> bool:
+        """Returns whether the bucket has enough tokens for an action costing `cost` tokens"""
+        return self.refill(now) >= min(cost, self.burst)
+
+    def take(self, cost: float = 1):
+        """Spends tokens on an action. Should only be called once allows() has said yes"""
+        self.tokens -= min(cost, self.burst)
+
+
+class RateLimiter:
+    """Flood control for posting messages. Every channel has a bucket shared by all its users, and every user has a
+    bucket of their own in each channel, so a single user cannot use up a whole channel's rate. On top of that, a global
+    bucket caps the number of websocket deliveries per second, protecting the event loop when many channels are busy.
+    Limits can be set for all channels in the rate_limits section of mm.yaml, and overridden per channel."""
+
+    def __init__(self, config: dict):
+        self.defaults = {**DEFAULT_RATE_LIMITS, "room": config.get("message_rate_limit", DEFAULT_RATE_LIMITS["room"])}
+        self.defaults.update(config.get("rate_limits") or {})
+        self.limits = {}  # Room name -> rate limits for that room
+        self.rooms = {}  # Room name -> TokenBucket
+        for room, data in config.get("channels", {}).items():
+            self.limits[room] = {**self.defaults, **(data.get("rate_limits") or {})}
+            self.rooms[room] = TokenBucket(self.limits[room]["room"], max(1, self.limits[room]["room"]))
+        self.users = {}  # (room, uid) -> TokenBucket
+        self.fanout = TokenBucket(self.defaults["fanout"], self.defaults["fanout"])
+        self.last_prune = time.monotonic()
+
+    def check(self, roomname: str, uid: str, recipients: int) -> typing.Optional[str]:
+        """Takes tokens for a message to a room if all buckets allow it. If not, returns the reason it was refused"""
+        now = time.monotonic()
+        if now - self.last_prune > 60:
+            self.prune(now)
+        limits = self.limits[roomname]
+        user = self.users.get((roomname, uid))
+        if not user:
+            user = self.users[(roomname, uid)] = TokenBucket(limits["user"], limits["burst"])
+        room = self.rooms[roomname]
+        if not user.allows(now):
+            return "You are sending messages too quickly. Please wait a moment and try again."
+        if not room.allows(now):
+            return "The chat is experiencing a large influx of messages and have been throttled. Please try again."
+        if not self.fanout.allows(now, recipients):
+            return "The chat is very busy at the moment. Please try again in a few seconds."
+        user.take()
+        room.take()
+        self.fanout.take(recipients)
+        return None
+
+    def prune(self, now: float):
+        """Forgets the buckets of users who have not posted for long enough for their bucket to be full again"""
+        self.users = {key: bucket for key, bucket in self.users.items() if bucket.refill(now) < bucket.burst}
+        self.last_prune = now
+
+
+class HistoryChunk:
+    """A sealed chunk of chat history: the encoded history frame for up to HISTORY_CHUNK_SIZE messages, along with
+    where in it each message starts, when it was posted and its key. Clients that only need part of a chunk get a
+    slice of it, so nothing is ever decoded or encoded again, and no per-message objects are kept around."""
+
+    __slots__ = ("frame", "offsets", "timestamps", "keys")
+
+    def __init__(self, prefix: str, frames: typing.List[str], timestamps: typing.List[float], keys: typing.List[bytes]):
+        self.frame = prefix + ",".join(frames) + "]}"
+        self.offsets = array.array("I")
+        offset = len(prefix)
+        for frame in frames:
+            self.offsets.append(offset)
+            offset += len(frame) + 1
+        self.timestamps = array.array("d", timestamps)
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def since(self, prefix: str, index: int) -> str:
+        """Returns a history frame for the messages in this chunk from an index onwards"""
+        return prefix + self.frame[self.offsets[index]:]
+
+    def remove(self, index: int, positions: dict):
+        """Removes a message, along with the comma separating it from its neighbour, and moves the messages after it
+        up one place in the positions index"""
+        start = self.offsets[index]
+        if index + 1 < len(self.offsets):
+            end = self.offsets[index + 1]
+        else:
+            end = len(self.frame) - 2  # Up to the closing ]}
+            if index:
+                start -= 1
+        self.frame = self.frame[:start] + self.frame[end:]
+        room = positions.pop(self.keys[index])[0]
+        del self.offsets[index]
+        del self.timestamps[index]
+        del self.keys[index]
+        for later in range(index, len(self.offsets)):
+            self.offsets[later] -= end - start
+            positions[self.keys[later]] = (room, self, later)
+
 
 class ChatRoom:
-    """A chat room with metadata and messages"""
+    """A chat room with metadata and messages. The most recent messages are kept in memory as encoded frames,
+    ready to be sent to clients: full chunks of history as HistoryChunks, and the rest (the tail) per message."""
 
     def __init__(self, state, name, title, topic):
         self.state: State = state
@@ -63,32 +935,137 @@ class ChatRoom:
         self.title = title
         self.topic = topic
         self.audit = []
-        self.flood_control = []  # Manages flood throttling by keeping timestamps of the last N messages
-        self.messages = [x for x in self.state.db.fetch("messages", limit=0, room=name)]
-        print(f"Fetched {len(self.messages)} message(s) from channel #{name}")
+        self.history_size = self.state.config.get("history_size", DEFAULT_HISTORY_SIZE)
+        self.prefix = '{"channel":%s,"history":[' % json_encode(name)  # Start of every history frame for this room
+        self.chunks: typing.List[HistoryChunk] = []
+        self.tail_frames: typing.List[str] = []  # Encoded frames of the messages after the last full chunk
+        self.tail_timestamps: typing.List[float] = []
+        self.tail_keys: typing.List[bytes] = []
+        self.history_tail = None  # Encoded history frame for the tail, if any
+        # Only the most recent messages are kept in memory, older ones are fetched from storage on demand
+        for timestamp, key, frame in self.state.store.frames(name, limit=self.history_size):
+            self.add_frame(timestamp, key, frame)
+        print(f"Fetched {len(self)} message(s) from channel #{name}")
+
+    def __len__(self):
+        """Number of messages in memory"""
+        return sum(len(chunk) for chunk in self.chunks) + len(self.tail_frames)
+
+    @property
+    def last_timestamp(self) -> float:
+        if self.tail_timestamps:
+            return self.tail_timestamps[-1]
+        return self.chunks[-1].timestamps[-1] if self.chunks and self.chunks[-1] else 0
+
+    def fetch_messages(self, before: float = None, limit: int = 0) -> typing.List[Message]:
+        """Fetches the most recent messages (optionally only those posted at or before a given timestamp) from storage,
+        in chronological order. If limit is 0, fetches all matching messages."""
+        return self.state.store.fetch(self.name, before, limit)
+
+    def fetch_frames(self, before: float = None, limit: int = 0) -> typing.List[str]:
+        """Same as fetch_messages, but returns the encoded websocket frames of the messages"""
+        return [frame for _, _, frame in self.state.store.frames(self.name, before, limit)]
+
+    def history_frame(self, frames: typing.List[str]) -> str:
+        """Joins a list of pre-encoded message frames into a single encoded history frame"""
+        return self.prefix + ",".join(frames) + "]}"
+
+    def history(self, since: float = 0) -> typing.List[str]:
+        """Returns the encoded history frames for all messages posted at or after a given timestamp. Clients resume
+        from the timestamp of the last message they saw, and other messages may share it, so the boundary is
+        inclusive, and clients skip the messages they already have."""
+        history = []
+        # Whole chunks can be sent as-is, the first one may need to be sliced
+        for chunk in self.chunks:
+            if chunk and chunk.timestamps[-1] >= since:
+                start = bisect.bisect_left(chunk.timestamps, since)
+                history.append(chunk.since(self.prefix, start) if start else chunk.frame)
+        start = bisect.bisect_left(self.tail_timestamps, since)
+        if start == 0 and self.tail_frames:  # The entire tail, use (or fill) the cache
+            if not self.history_tail:
+                self.history_tail = self.history_frame(self.tail_frames)
+            history.append(self.history_tail)
+        elif start < len(self.tail_frames):
+            history.append(self.history_frame(self.tail_frames[start:]))
+        return history
 
     def add_message(self, sender, realname, message):
         """Adds a message to the chat room, sending it to all websocket subscribers"""
         if not message:
             return  # Don't need blank lines!
-        message = {
-            "timestamp": time.time(),
-            "uid": str(uuid.uuid4()),
-            "room": self.name,
-            "sender": sender,
-            "realname": realname,
-            "message": message,
-        }
-        self.state.db.insert("messages", message)
-        self.messages.append(message)
-        for subscriber, messages in self.state.pending_messages.items():
-            messages.append(message)
+        message = Message(
+            str(uuid.uuid4()),
+            max(time.time(), self.last_timestamp + HISTORY_TIMESTAMP_STEP),  # Keep history ordered, without ties
+            self.name,
+            sender,
+            realname,
+            message,
+        )
+        self.state.store.append(message)
+        self.state.bus.publish("message", message.as_row())
+
+    def add_frame(self, timestamp: float, key: bytes, frame: str):
+        """Adds an encoded message frame to the in-memory history, sealing off the tail as a chunk once it is full,
+        and dropping the oldest chunk once there are enough messages without it. Keeps the positions index of
+        the state up to date: message key -> (room, chunk or None for the tail, index in it)."""
+        positions = self.state.positions
+        # Messages from other workers in the cluster can arrive out of order, so keep the tail sorted. Anything
+        # older than the sealed chunks is filed as if it was posted at the end of the last one.
+        if self.chunks and self.chunks[-1] and timestamp < self.chunks[-1].timestamps[-1]:
+            timestamp = self.chunks[-1].timestamps[-1]
+        index = bisect.bisect_right(self.tail_timestamps, timestamp)
+        self.tail_frames.insert(index, frame)
+        self.tail_timestamps.insert(index, timestamp)
+        self.tail_keys.insert(index, key)
+        for later in range(index, len(self.tail_keys)):
+            positions[self.tail_keys[later]] = (self, None, later)
+        self.history_tail = None
+        if len(self.tail_frames) >= HISTORY_CHUNK_SIZE:
+            chunk = HistoryChunk(self.prefix, self.tail_frames, self.tail_timestamps, self.tail_keys)
+            for index, key in enumerate(chunk.keys):
+                positions[key] = (self, chunk, index)
+            self.chunks.append(chunk)
+            self.tail_frames = []
+            self.tail_timestamps = []
+            self.tail_keys = []
+            if len(self) - len(self.chunks[0]) >= self.history_size:
+                for key in self.chunks[0].keys:
+                    positions.pop(key, None)
+                del self.chunks[0]
+
+    def append(self, message: Message):
+        """Appends a new message to the in-memory history, and sends it to all websocket subscribers"""
+        frame = json_encode(message.frame())  # Encode once, send the same frame to everyone
+        self.add_frame(message.timestamp, message_key(message.msgid), frame)
+        self.state.metrics.inc("asfmm_messages_total", labels=(("room", self.name),))
+        self.state.broadcast(frame, track=True)
+
+    def redact(self, msgid: str) -> bool:
+        """Removes a message from the in-memory history, if present"""
+        position = self.state.positions.get(message_key(msgid))
+        if not position or position[0] is not self:
+            return False
+        _, chunk, index = position
+        if chunk:
+            chunk.remove(index, self.state.positions)
+            return True
+        del self.state.positions[self.tail_keys[index]]
+        del self.tail_frames[index]
+        del self.tail_timestamps[index]
+        del self.tail_keys[index]
+        for later in range(index, len(self.tail_keys)):
+            self.state.positions[self.tail_keys[later]] = (self, None, later)
+        self.history_tail = None
+        return True
 
 
 class Quorum:
     """Class for keeping persistent score of quorum"""
-    def __init__(self, db: asfpy.sqlite.DB):
+    def __init__(self, db: asfpy.sqlite.DB, db_writer: DBWriter, bus: EventBus):
         self.db = db
+        self.db_writer = db_writer
+        self.bus = bus
+        self.bus.subscribe("quorum", self.apply)
         # Check and create table if not present
         if not self.db.table_exists("quorum"):
             print("Creating DB table for quorum")
@@ -99,6 +1076,14 @@ class Quorum:
         # Fetch persistent records
         self._attendees = set([x["name"] for x in self.db.fetch("quorum", limit=0, type="attendee")])
         self._proxies = set([x["name"] for x in self.db.fetch("quorum", limit=0, type="proxy")])
+        # Every change since startup, in order. Each member can only be added once as an attendee and once
+        # as a proxy, so this never grows beyond twice the size of the membership.
+        self.changes: typing.List[dict] = []
+
+    @property
+    def version(self) -> int:
+        """Bumped whenever quorum changes, so presence knows when to recalculate"""
+        return len(self.changes)
 
     @property
     def members(self):
@@ -117,15 +1102,967 @@ class Quorum:
 
     def add(self, member: str):
         if member and member not in self._attendees:
-            self._attendees.add(member)  # Add in memory
-            self._proxies.discard(member)  # Remove from proxy list if found
-            self.db.insert("quorum", {"name": member, "type": "attendee"})  # Add to persistent DB
+            self.db_writer.insert("quorum", {"name": member, "type": "attendee"})  # Add to persistent DB
+            self.bus.publish("quorum", {"name": member, "type": "attendee"})  # Add in memory, in every worker
 
     def add_proxy(self, member: str):
-        if member and member not in self.members:
-            self._proxies.add(member)  # Add in memory
-            self.db.insert("quorum", {"name": member, "type": "proxy"})  # Add to persistent DB
+        if member and member not in self._attendees and member not in self._proxies:
+            self.db_writer.insert("quorum", {"name": member, "type": "proxy"})  # Add to persistent DB
+            self.bus.publish("quorum", {"name": member, "type": "proxy"})  # Add in memory, in every worker
+
+    def add_proxies(self, members: typing.Iterable[str]) -> typing.List[str]:
+        """Adds any number of proxies at once, skipping those already accounted for. The new proxies are written
+        to the database in a single statement. Returns the list of proxies that were added."""
+        added = sorted(set(members) - self._attendees - self._proxies)
+        if added:
+            self.db_writer.executemany("INSERT INTO quorum (name, type) VALUES (?, ?);", [(member, "proxy") for member in added])
+            for member in added:
+                self.bus.publish("quorum", {"name": member, "type": "proxy"})  # Add in memory, in every worker
+        return added
+
+    def apply(self, record: dict):
+        """Applies a quorum change (published by add, add_proxy or add_proxies) in memory"""
+        if record["type"] == "attendee":
+            self._attendees.add(record["name"])
+            self._proxies.discard(record["name"])  # Remove from proxy list if found
+        else:
+            self._proxies.add(record["name"])
+        self.changes.append(record)
+
+
+class MessageStore(abc.ABC):
+    """Where chat messages are kept for good. Rooms keep their recent messages in memory, and go here for the rest.
+    Everything is called from the event loop, except scan(), which may be called from another thread (for exports).
+    Writes are handed to the DB writer thread, so they must not be expected to show up in reads right away."""
+
+    @abc.abstractmethod
+    def append(self, message: Message):
+        """Stores a new message"""
+
+    @abc.abstractmethod
+    def redact(self, msgid: str):
+        """Removes a message, in whichever room it was posted"""
+
+    @abc.abstractmethod
+    def fetch(self, room: str, before: float = None, limit: int = 0) -> typing.List[Message]:
+        """Returns the most recent messages in a room (optionally only those posted at or before a given timestamp),
+        in chronological order. If limit is 0, returns all matching messages. Several messages can share a timestamp,
+        so pages are never split between them: a page holds all messages at the given timestamp, and the limit
+        most recent ones before it, plus any others sharing the timestamp of the oldest. Clients page with the
+        timestamp of the oldest message they have, and skip the ones they already have."""
+
+    @abc.abstractmethod
+    def frames(self, room: str, before: float = None, limit: int = 0) -> typing.List[typing.Tuple[float, bytes, str]]:
+        """Same as fetch, but returns (timestamp, message key, encoded websocket frame) for every message"""
+
+    @abc.abstractmethod
+    def rooms(self) -> typing.List[str]:
+        """Returns the names of all rooms with stored messages"""
+
+    @abc.abstractmethod
+    def scan(self, room: str) -> typing.Iterator[Message]:
+        """Yields all messages in a room in chronological order, using its own connection or file handles"""
+
+    def close(self):
+        pass
+
+
+class SQLiteStore(MessageStore):
+    """Keeps messages in the messages table of the SQLite database. Writes go through the DB writer thread."""
+
+    def __init__(self, db: asfpy.sqlite.DB, db_writer: DBWriter, db_name: str):
+        self.db = db
+        self.db_writer = db_writer
+        self.db_name = db_name
+        if not db.table_exists("messages"):
+            print("Creating DB table for messages")
+            db.runc(DB_CREATE_MESSAGES)
+        db.runc(DB_INDEX_MESSAGES)  # Added after the fact, so ensure it exists on older databases, too
+
+    def append(self, message: Message):
+        self.db_writer.insert("messages", message.as_row())
+
+    def redact(self, msgid: str):
+        self.db_writer.delete("messages", uid=msgid)
+
+    def fetch(self, room: str, before: float = None, limit: int = 0) -> typing.List[Message]:
+        statement = "SELECT * FROM messages WHERE room = ?"
+        args = [room]
+        if before is not None:
+            statement += " AND timestamp <= ?"
+            args.append(before)
+        if limit:
+            # Back to the timestamp of the limit-th message before the boundary, including any others sharing it
+            statement += (
+                " AND timestamp >= COALESCE((SELECT timestamp FROM messages WHERE room = ?%s"
+                " ORDER BY timestamp DESC LIMIT 1 OFFSET ?), 0)" % ("" if before is None else " AND timestamp < ?")
+            )
+            args.extend([room] + ([] if before is None else [before]) + [limit - 1])
+        statement += " ORDER BY timestamp DESC"
+        self.db.run(statement, *args)
+        return [Message.from_row(row) for row in reversed(self.db.cursor.fetchall())]
+
+    def frames(self, room: str, before: float = None, limit: int = 0) -> typing.List[typing.Tuple[float, bytes, str]]:
+        return [
+            (message.timestamp, message_key(message.msgid), json_encode(message.frame()))
+            for message in self.fetch(room, before, limit)
+        ]
+
+    def rooms(self) -> typing.List[str]:
+        self.db.run("SELECT DISTINCT room FROM messages")
+        return [row["room"] for row in self.db.cursor.fetchall()]
+
+    def scan(self, room: str) -> typing.Iterator[Message]:
+        db = asfpy.sqlite.DB(self.db_name)
+        try:
+            for row in db.connector.execute("SELECT * FROM messages WHERE room = ? ORDER BY timestamp", (room,)):
+                yield Message.from_row(row)
+        finally:
+            db.connector.close()
+
+
+class LogSegment:
+    """A segment file of a message log, memory-mapped for reading"""
+
+    def __init__(self, path: str, base: int):
+        self.path = path
+        self.base = base  # Offset of the start of this segment within the whole log
+        self.size = 0  # Size of the file, as far as it is mapped
+        self.end = 0  # Offset just past the last valid record read so far
+        self.gaps = {}  # Offset of corrupt data -> offset of the next valid record after it
+        self.map = None
+
+    def remap(self):
+        """Maps the file again if its size changed (it grew, or was truncated)"""
+        size = os.path.getsize(self.path)
+        if size != self.size:
+            self.close()
+            if size:
+                with open(self.path, "rb") as f:
+                    self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.size = size
+
+    def close(self):
+        if self.map:
+            self.map.close()
+            self.map = None
+
+
+class MessageLog:
+    """An append-only log of records, split over segment files named after their offset within the log. Records are
+    length-prefixed and checksummed. Segments are scanned once when the log is opened, and new records (written by
+    this or another worker) as they appear. Every LOG_INDEX_INTERVAL-th record is added to a sparse timestamp index,
+    so reads only need to scan from the nearest index entry. When a writable log is opened, a torn or corrupt record
+    at the end of the last segment (from a crash mid-write) is truncated. Corrupt data anywhere else is skipped up to
+    the next valid record, with a warning. Appends are serialized between workers by
+    locking a lock file. Within a worker, appends may run on another thread than reads, so both hold self.lock."""
+
+    def __init__(self, directory: str, segment_size: int = DEFAULT_SEGMENT_SIZE, writable: bool = True):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segments: typing.List[LogSegment] = []
+        self.scanning = 0  # Number of the segment that new records are read from
+        self.count = 0  # Number of valid records read so far
+        self.index = []  # (segment number, offset) of every LOG_INDEX_INTERVAL-th record
+        self.timestamps = []  # Timestamps of the records in the index, for bisecting
+        self.redacted = set()  # Keys of messages redacted in this log
+        self.lock_fd = None
+        self.lock = threading.RLock()  # Guards the segments and index against reads and appends on other threads
+        self.writer = None  # (segment number, file descriptor) of the segment being appended to
+        if writable:
+            os.makedirs(directory, exist_ok=True)
+            self.lock_fd = os.open(os.path.join(directory, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+            try:
+                self.refresh(recover=True)
+            finally:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+        else:
+            self.refresh()
+
+    @staticmethod
+    def parse(segment: LogSegment, offset: int, verify: bool = True) -> typing.Optional[tuple]:
+        """Parses the record at an offset in a segment. Returns (type, timestamp, key, payload start, payload end),
+        or None if the record is incomplete or fails its checksum."""
+        body_start = offset + LOG_RECORD_PREFIX.size
+        payload_start = body_start + LOG_RECORD_BODY.size
+        if payload_start > segment.size:
+            return None
+        length, checksum = LOG_RECORD_PREFIX.unpack_from(segment.map, offset)
+        payload_end = payload_start + length
+        if payload_end > segment.size:
+            return None
+        if verify and zlib.crc32(segment.map[body_start:payload_end]) != checksum:
+            return None
+        kind, timestamp, key = LOG_RECORD_BODY.unpack_from(segment.map, body_start)
+        return kind, timestamp, key, payload_start, payload_end
+
+    def resync(self, segment: LogSegment, offset: int) -> typing.Optional[int]:
+        """Returns the offset of the first valid record after an offset in a segment, if there is one"""
+        last = segment.size - LOG_RECORD_PREFIX.size - LOG_RECORD_BODY.size
+        for candidate in range(offset + 1, last + 1):
+            kind = segment.map[candidate + LOG_RECORD_PREFIX.size]
+            if kind in (LOG_RECORD_MESSAGE, LOG_RECORD_REDACTION) and self.parse(segment, candidate):
+                return candidate
+        return None
+
+    def refresh(self, recover: bool = False):
+        """Reads any records written since the last refresh. Corrupt data followed by valid records is skipped.
+        If recover is set (and we hold the lock file), truncates the last segment after its last valid record."""
+        with self.lock:
+            if os.path.isdir(self.directory):
+                names = sorted(name for name in os.listdir(self.directory) if name.endswith(".log"))
+                for name in names[len(self.segments):]:
+                    self.segments.append(LogSegment(os.path.join(self.directory, name), int(name[:-4])))
+            while self.scanning < len(self.segments):
+                number = self.scanning
+                segment = self.segments[number]
+                segment.remap()
+                while segment.end < segment.size:
+                    record = self.parse(segment, segment.end)
+                    if record is None:
+                        # A torn write can only be at the very end, so if a valid record follows, this is damage
+                        resume = self.resync(segment, segment.end)
+                        if resume is None:
+                            break
+                        print(f"Skipping {resume - segment.end} bytes of corrupt data in {segment.path} at {segment.end} bytes")
+                        segment.gaps[segment.end] = resume
+                        segment.end = resume
+                        continue
+                    kind, timestamp, key, _, offset = record
+                    if self.count % LOG_INDEX_INTERVAL == 0:
+                        self.index.append((number, segment.end))
+                        self.timestamps.append(timestamp)
+                    if kind == LOG_RECORD_REDACTION:
+                        self.redacted.add(key)
+                    self.count += 1
+                    segment.end = offset
+                last = number == len(self.segments) - 1
+                if segment.end < segment.size:
+                    if last and recover:
+                        print(f"Truncating {segment.path} after the last valid record, at {segment.end} bytes")
+                        os.truncate(segment.path, segment.end)
+                        segment.remap()
+                    elif not last:  # Sealed segments are never written to again, and nothing valid follows
+                        print(f"Corrupt record at the end of {segment.path} at {segment.end} bytes, dropping the rest of it")
+                if last:
+                    break  # The rest of the last segment may still be being written
+                self.scanning += 1
+
+    def append(self, kind: int, timestamp: float, key: bytes, payload: bytes):
+        """Appends a record to the log, starting a new segment if the current one is full"""
+        body = LOG_RECORD_BODY.pack(kind, timestamp, key)
+        record = LOG_RECORD_PREFIX.pack(len(payload), zlib.crc32(payload, zlib.crc32(body))) + body + payload
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        try:
+            with self.lock:
+                # Catch up with other workers, so we know where the log ends. As every writer holds the lock file,
+                # anything incomplete at the end was left by a worker that died mid-write, and can go.
+                self.refresh(recover=True)
+                if not self.segments or self.segments[-1].end >= self.segment_size:
+                    base = self.segments[-1].base + self.segments[-1].end if self.segments else 0
+                    path = os.path.join(self.directory, f"{base:020d}.log")
+                    open(path, "ab").close()
+                    self.segments.append(LogSegment(path, base))
+                if not self.writer or self.writer[0] != len(self.segments) - 1:
+                    self.close_writer()
+                    fd = os.open(self.segments[-1].path, os.O_WRONLY | os.O_APPEND)
+                    self.writer = (len(self.segments) - 1, fd)
+                os.write(self.writer[1], record)
+                self.refresh()
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def records(self, number: int = 0, offset: int = 0) -> typing.Iterator[tuple]:
+        """Yields (type, timestamp, key, payload) for every record from a position in the log onwards"""
+        while number < len(self.segments):
+            segment = self.segments[number]
+            while offset < segment.end:
+                if offset in segment.gaps:
+                    offset = segment.gaps[offset]
+                    continue
+                kind, timestamp, key, start, offset = self.parse(segment, offset, verify=False)  # Checked when scanned
+                yield kind, timestamp, key, segment.map[start:offset]
+            number += 1
+            offset = 0
+
+    def read(self, before: float = None, limit: int = 0, redacted: typing.Container = frozenset()) -> typing.List[tuple]:
+        """Returns (timestamp, key, payload) of the most recent message records (optionally only those from at or
+        before a timestamp), in order, leaving out redacted messages. If limit is 0, returns all of them."""
+        with self.lock:  # Appends on the writer thread may remap segments
+            self.refresh()
+            stop = len(self.index) if before is None else bisect.bisect_right(self.timestamps, before)
+            back = -(-limit // LOG_INDEX_INTERVAL) + 1 if limit else len(self.index)  # Index entries to go back from stop
+            while True:
+                first = max(0, stop - back)
+                payloads = []
+                for kind, timestamp, key, payload in self.records(*(self.index[first] if self.index else (0, 0))):
+                    if before is not None and timestamp > before:
+                        break
+                    if kind == LOG_RECORD_MESSAGE and key not in redacted:
+                        payloads.append((timestamp, key, payload))
+                # Like MessageStore.fetch, a page is never split between messages sharing a timestamp: it goes back
+                # to the timestamp of the limit-th message before the boundary. Once an even older message shows up,
+                # we know we have all messages at that timestamp.
+                older = [timestamp for timestamp, _, _ in payloads if before is None or timestamp < before]
+                cut = heapq.nlargest(limit, older)[-1] if limit and len(older) > limit else None
+                if cut is not None and (first == 0 or min(older) < cut):
+                    return [record for record in payloads if record[0] >= cut]
+                if first == 0:
+                    return payloads
+                back *= 2  # Too many redactions (or messages sharing a timestamp) to fill the page, look further back
+
+    def close_writer(self):
+        if self.writer:
+            os.close(self.writer[1])
+            self.writer = None
+
+    def close(self):
+        self.close_writer()
+        for segment in self.segments:
+            segment.close()
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+
+class LogStore(MessageStore):
+    """Keeps messages in append-only segmented logs on disk, one per room, in rooms/<name> under path. Records hold the
+    encoded websocket frames of messages, so history can be read back without rebuilding messages. Redactions are
+    appended to a log of their own (as the room of a redacted message is not always known), and left out on reads.
+    If given a DB writer, appends are done on its thread, as they wait for other workers and write to disk."""
+
+    def __init__(self, path: str, segment_size: int = DEFAULT_SEGMENT_SIZE, writable: bool = True, db_writer: DBWriter = None):
+        self.path = path
+        self.segment_size = segment_size
+        self.writable = writable
+        self.db_writer = db_writer
+        self.logs: typing.Dict[str, MessageLog] = {}  # room name -> message log
+        self.redactions = MessageLog(os.path.join(path, "redactions"), segment_size, writable)
+
+    def log(self, room: str) -> MessageLog:
+        if room not in self.logs:
+            if not room or room.startswith(".") or os.sep in room:
+                raise ValueError(f"Invalid room name for a message log: {room!r}")
+            self.logs[room] = MessageLog(os.path.join(self.path, "rooms", room), self.segment_size, self.writable)
+        return self.logs[room]
+
+    @property
+    def redacted(self) -> set:
+        self.redactions.refresh()
+        return self.redactions.redacted
+
+    def write(self, log: MessageLog, kind: int, timestamp: float, key: bytes, payload: bytes):
+        """Appends a record to a log, on the DB writer thread if there is one"""
+        if self.db_writer:
+            self.db_writer.call(log.append, kind, timestamp, key, payload)
+        else:
+            log.append(kind, timestamp, key, payload)
+
+    def append(self, message: Message):
+        payload = json_encode(message.frame()).encode("utf-8")
+        self.write(self.log(message.room), LOG_RECORD_MESSAGE, message.timestamp, message_key(message.msgid), payload)
+
+    def redact(self, msgid: str):
+        self.write(self.redactions, LOG_RECORD_REDACTION, time.time(), message_key(msgid), msgid.encode("utf-8"))
+
+    def fetch(self, room: str, before: float = None, limit: int = 0) -> typing.List[Message]:
+        return [Message.from_frame(json.loads(payload)) for _, _, payload in self.log(room).read(before, limit, self.redacted)]
+
+    def frames(self, room: str, before: float = None, limit: int = 0) -> typing.List[typing.Tuple[float, bytes, str]]:
+        return [(timestamp, key, payload.decode("utf-8")) for timestamp, key, payload in self.log(room).read(before, limit, self.redacted)]
+
+    def rooms(self) -> typing.List[str]:
+        directory = os.path.join(self.path, "rooms")
+        return sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+
+    def scan(self, room: str) -> typing.Iterator[Message]:
+        log = MessageLog(os.path.join(self.path, "rooms", room), writable=False)
+        redactions = MessageLog(os.path.join(self.path, "redactions"), writable=False)
+        try:
+            for kind, _, key, payload in log.records():
+                if kind == LOG_RECORD_MESSAGE and key not in redactions.redacted:
+                    yield Message.from_frame(json.loads(payload))
+        finally:
+            log.close()
+            redactions.close()
+
+    def close(self):
+        for log in self.logs.values():
+            log.close()
+        self.redactions.close()
+
+
+class SearchIndex:
+    """Full-text search over all chat messages, using an SQLite FTS5 index of the messages table.
+    If this SQLite was built without FTS5, search is simply unavailable. Searches can take a while on a large
+    history, so they are meant to be run in a thread (through asyncio.to_thread), on a connection of its own."""
+
+    def __init__(self, db: typing.Optional[asfpy.sqlite.DB], db_name: str = None):
+        self.db = db
+        self.db_name = db_name
+        self.readers = threading.local()  # Read connection for each thread searches are run in
+        self.available = db is not None  # Only messages kept in the database can be searched
+        if self.available and not db.table_exists("messages_search"):
+            print("Building full-text search index of messages")
+            try:
+                self.create(db.connector)
+            except sqlite3.OperationalError as e:
+                print(f"Full-text search is not available: {e}")
+                self.available = False
+
+    @staticmethod
+    def create(connector: sqlite3.Connection, rebuild: bool = False):
+        """Creates the search index and its triggers, and indexes all existing messages. If rebuild is set,
+        any existing index is dropped first. All of this happens in a single transaction, which is begun explicitly,
+        as our connections are in autocommit mode (and sqlite3 would not begin one for the CREATE statements anyway)."""
+        connector.execute("BEGIN")
+        try:
+            if rebuild:
+                for statement in DB_DROP_SEARCH:
+                    connector.execute(statement)
+            for statement in DB_CREATE_SEARCH:
+                connector.execute(statement)
+            connector.execute("""INSERT INTO "messages_search" ("messages_search") VALUES ('rebuild');""")
+            connector.execute("COMMIT")
+        except BaseException:
+            connector.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def match_expression(query: str) -> str:
+        """Turns a plain search query into an FTS5 match expression, matching messages that contain every word.
+        Words are quoted, so FTS5 syntax in the query is taken literally, except for a trailing * (prefix search)."""
+        terms = []
+        for word in query.split():
+            prefix = word.endswith("*") and len(word) > 1
+            word = word.rstrip("*") if prefix else word
+            terms.append('"%s"%s' % (word.replace('"', '""'), "*" if prefix else ""))
+        return " ".join(terms)
+
+    def reader(self) -> asfpy.sqlite.DB:
+        """Returns the read connection for the current thread, opening it if needed"""
+        if not hasattr(self.readers, "db"):
+            self.readers.db = asfpy.sqlite.DB(self.db_name)
+        return self.readers.db
+
+    def search(
+        self,
+        query: str,
+        room: str = None,
+        sender: str = None,
+        after: float = None,
+        before: float = None,
+        limit: int = 25,
+        offset: int = 0,
+    ) -> typing.List[typing.Tuple[Message, float]]:
+        """Finds messages matching a query, optionally only in one room, from one sender, or within a time range.
+        Returns (message, score) pairs, best match first. Lower scores are better matches. Uses the read connection
+        of the calling thread, so this can be called from any thread."""
+        expression = self.match_expression(query)
+        if not expression:
+            return []
+        statement = (
+            'SELECT messages.*, bm25("messages_search") AS score FROM "messages_search" '
+            'JOIN messages ON messages.rowid = "messages_search".rowid WHERE "messages_search" MATCH ?'
+        )
+        args = [expression]
+        for condition, value in (
+            ("messages.room = ?", room),
+            ("messages.sender = ?", sender),
+            ("messages.timestamp >= ?", after),
+            ("messages.timestamp < ?", before),
+        ):
+            if value is not None:
+                statement += " AND " + condition
+                args.append(value)
+        statement += " ORDER BY score, messages.timestamp DESC LIMIT ? OFFSET ?"
+        args.extend((limit, offset))
+        db = self.reader()
+        db.run(statement, *args)
+        return [(Message.from_row(row), row["score"]) for row in db.cursor.fetchall()]
+
 
+class Moderation:
+    """Blocked (muted) and banned users, persisted in the database. Changes are published on the event bus, and
+    passed on to every callback subscribed here, so they can take effect right away."""
+
+    STATUSES = {"block": "blocked", "unblock": "blocked", "ban": "banned", "unban": "banned"}
+
+    def __init__(self, db: asfpy.sqlite.DB, db_writer: DBWriter, bus: EventBus):
+        self.db_writer = db_writer
+        self.bus = bus
+        self.bus.subscribe("moderation", self.apply)
+        self.subscribers: typing.List[typing.Callable] = []
+        if not db.table_exists("moderation"):
+            print("Creating DB table for moderation")
+            db.runc(DB_CREATE_MODERATION)
+        self.blocked: set = set(x["uid"] for x in db.fetch("moderation", limit=0, status="blocked"))
+        self.banned: set = set(x["uid"] for x in db.fetch("moderation", limit=0, status="banned"))
+        self.frame = ""  # Current moderation lists, for admins
+        self.update()
+
+    def subscribe(self, callback: typing.Callable):
+        """Calls callback(action, uid) whenever someone is blocked, banned, unblocked or unbanned"""
+        self.subscribers.append(callback)
+
+    def moderate(self, action: str, who: str):
+        """Blocks, bans, unblocks or unbans a user in every worker"""
+        status = self.STATUSES[action]
+        if action.startswith("un"):
+            self.db_writer.delete("moderation", uid=who, status=status)
+        else:
+            self.db_writer.execute("INSERT OR IGNORE INTO moderation (uid, status) VALUES (?, ?);", who, status)
+        self.bus.publish("moderation", {"action": action, "user": who})
+
+    def apply(self, data: dict):
+        """Applies a moderation change (published by moderate) in memory, and lets subscribers know"""
+        action, who = data["action"], data["user"]
+        statuses = getattr(self, self.STATUSES[action])
+        if action.startswith("un"):
+            statuses.discard(who)
+        else:
+            statuses.add(who)
+        self.update()
+        for callback in self.subscribers:
+            callback(action, who)
+
+    def update(self):
+        self.frame = json_encode({"moderation": {"blocked": sorted(self.blocked), "banned": sorted(self.banned)}})
+
+    def is_muted(self, uid: str) -> bool:
+        """Returns whether a user is not allowed to post"""
+        return uid in self.blocked or uid in self.banned
+
+
+class Invites:
+    """Guest invites. Outstanding invites are kept in memory, with a heap ordered by expiry time so expired ones
+    can be dropped cheaply, and persisted to the database so they survive a restart. Redeemed invites stay in the
+    database with the guest id they were given. The database is the authority on redemption: invites are committed
+    before the link is handed out, and redeemed by a single UPDATE, so no two workers can redeem the same invite, or
+    hand out the same guest id. Neither happens on the event loop: new invites go through the DB writer, and
+    redemptions run in a thread, on a connection of their own."""
+
+    def __init__(self, db: asfpy.sqlite.DB, db_writer: DBWriter, db_name: str, bus: EventBus, ttl: float, quota: int):
+        self.db = db
+        self.db_writer = db_writer
+        self.db_name = db_name
+        self.connections = threading.local()  # Connection for each thread redemptions are run in
+        self.bus = bus
+        self.ttl = ttl
+        self.quota = quota
+        self.bus.subscribe("invite", self.on_invite)
+        self.bus.subscribe("invite_redeemed", self.on_redeemed)
+        if not db.table_exists("invites"):
+            print("Creating DB table for invites")
+            db.runc(DB_CREATE_INVITES)
+        db.runc("DELETE FROM invites WHERE guest_id IS NULL AND expires < ?", time.time())
+        self.invites: typing.Dict[str, dict] = {}  # code -> invite
+        self.expiry: typing.List[tuple] = []  # Heap of (expires, code)
+        self.outstanding = collections.Counter()  # inviter -> number of outstanding invites
+        db.run("SELECT * FROM invites WHERE guest_id IS NULL")
+        for row in db.cursor.fetchall():
+            self.on_invite({"code": row["code"], "invite": dict(row)})
+        print(f"Loaded {len(self.invites)} outstanding invites")
+
+    async def create(self, inviter: str, inviter_name: str, name: str) -> typing.Optional[dict]:
+        """Creates a new invite, or returns None if the inviter has used up their quota"""
+        self.expire()
+        if self.outstanding[inviter] >= self.quota:
+            return None
+        now = time.time()
+        invite = {
+            "code": str(uuid.uuid4()),
+            "created": now,
+            "expires": now + self.ttl,
+            "inviter": inviter,
+            "inviter_name": inviter_name,
+            "name": name,
+        }
+        self.db_writer.insert("invites", invite)
+        self.bus.publish("invite", {"code": invite["code"], "invite": invite})  # Register (and count) in every worker
+        await self.db_writer.flush()  # Any worker may be asked to redeem it as soon as the link is handed out
+        return invite
+
+    def connection(self) -> asfpy.sqlite.DB:
+        """Returns the database connection for the current thread, opening it if needed"""
+        if not hasattr(self.connections, "db"):
+            self.connections.db = asfpy.sqlite.DB(self.db_name)
+        return self.connections.db
+
+    def claim(self, code: str) -> typing.Optional[dict]:
+        """Marks an unused invite as redeemed in the database, giving it the next guest id. Returns the updated
+        invite, or None if there is no such (unused) invite. Blocks while other connections write, so this is
+        run in a thread."""
+        db = self.connection()
+        # The write lock is taken right away, so the check for an unused invite and the next guest id are atomic
+        db.run("BEGIN IMMEDIATE")
+        try:
+            db.run(
+                "UPDATE invites SET guest_id = (SELECT COALESCE(MAX(guest_id), 0) + 1 FROM invites) "
+                "WHERE code = ? AND guest_id IS NULL AND expires >= ?;",
+                code,
+                time.time(),
+            )
+            row = None
+            if db.cursor.rowcount == 1:
+                db.run("SELECT * FROM invites WHERE code = ?;", code)
+                row = db.cursor.fetchone()
+            db.run("COMMIT")
+        except BaseException:
+            db.run("ROLLBACK")
+            raise
+        return dict(row) if row else None
+
+    async def redeem(self, code: str) -> typing.Optional[dict]:
+        """Redeems an invite, returning it along with a new guest id, or None if there is no such (unused) invite"""
+        self.expire()
+        invite = await asyncio.to_thread(self.claim, code)
+        if invite:
+            self.bus.publish("invite_redeemed", {"code": code, "guest_id": invite["guest_id"]})  # Remove it in every worker
+        return invite
+
+    def on_invite(self, data: dict):
+        invite = data["invite"]
+        self.invites[data["code"]] = invite
+        heapq.heappush(self.expiry, (invite["expires"], data["code"]))
+        self.outstanding[invite["inviter"]] += 1
+
+    def on_redeemed(self, data: dict):
+        self.remove(data["code"])
+
+    def remove(self, code: str):
+        """Forgets an outstanding invite. Its entry in the expiry heap is skipped when it comes up."""
+        invite = self.invites.pop(code, None)
+        if invite:
+            self.outstanding[invite["inviter"]] -= 1
+            if not self.outstanding[invite["inviter"]]:
+                del self.outstanding[invite["inviter"]]
+
+    def expire(self):
+        """Forgets all invites that have expired. They are removed from the database at the next restart."""
+        now = time.time()
+        while self.expiry and self.expiry[0][0] < now:
+            _, code = heapq.heappop(self.expiry)
+            self.remove(code)
+
+
+class Presence:
+    """Keeps track of who is currently attending, and the presence frames shared by all websockets. Websockets get
+    a full snapshot when they connect, and from then on only the changes (deltas) since the previous version."""
+
+    def __init__(self, state):
+        self.state: State = state
+        self.last_seen = collections.OrderedDict()  # uid -> last seen, least recently seen first
+        self.current: set = set()  # Everyone seen within the last WEBSOCKET_TIMEOUT seconds
+        self.version = 0  # Bumped whenever a new delta is made
+        self.log = collections.deque(maxlen=PRESENCE_LOG_SIZE)  # (version, frame) for recent deltas
+        self.snapshot_frame = None  # Cached snapshot of the current version, built on demand
+        self.published: set = set()  # Who was present as of the latest delta
+        self.published_max = 0
+        self.published_required = 0
+        self.ticks = 0
+        self.changed = True
+        self.quorum_version = 0
+        self.touched: set = set()  # Users seen by this worker since the last tick, for letting other workers know
+        self.state.bus.subscribe("presence", self.seen)
+
+    def touch(self, uid: str, local: bool = True):
+        """Marks a user as present right now. Users connected to other workers are marked with local=False."""
+        now = time.time()
+        self.state.attendees[uid] = now
+        self.last_seen[uid] = now
+        self.last_seen.move_to_end(uid)
+        if local:
+            self.touched.add(uid)
+        if uid not in self.current:
+            self.current.add(uid)
+            self.changed = True
+
+    def seen(self, uids: typing.List[str]):
+        """Marks users connected to other workers as present"""
+        for uid in uids:
+            self.touch(uid, local=False)
+
+    def expire(self):
+        """Removes everyone we haven't heard from in WEBSOCKET_TIMEOUT seconds. As last_seen is ordered by
+        time, we only ever need to look at the front of it."""
+        deadline = time.time() - WEBSOCKET_TIMEOUT
+        while self.last_seen:
+            uid, seen = next(iter(self.last_seen.items()))
+            if seen >= deadline:
+                break
+            self.last_seen.popitem(last=False)
+            self.current.discard(uid)
+            self.changed = True
+
+    def update(self):
+        """Records what changed since the previous version as a new delta, and bumps the version"""
+        self.changed = False
+        self.version += 1
+        self.snapshot_frame = None
+        delta = {"delta": self.version}
+        current = set(self.current)
+        if current - self.published:
+            delta["joined"] = list(current - self.published)
+        if self.published - current:
+            delta["left"] = list(self.published - current)
+        self.published = current
+        if len(self.state.attendees) != self.published_max:
+            self.published_max = delta["max"] = len(self.state.attendees)
+        required = math.ceil(len(self.state.members) / 3)
+        if required != self.published_required:
+            self.published_required = delta["required"] = required
+        changes = self.state.quorum.changes[self.quorum_version:]
+        self.quorum_version += len(changes)
+        attended = [record["name"] for record in changes if record["type"] == "attendee"]
+        proxied = [record["name"] for record in changes if record["type"] == "proxy"]
+        if attended:
+            delta["attended"] = attended
+        if proxied:
+            delta["proxied"] = proxied
+        self.log.append((self.version, json_encode(delta)))
+
+    def snapshot(self) -> str:
+        """Returns a frame with the full presence and quorum lists as of the current version"""
+        if not self.snapshot_frame:
+            self.snapshot_frame = json_encode({
+                "pong": str(uuid.uuid4()),
+                "version": self.version,
+                "current": list(self.published),
+                "attendees": len(self.published),
+                "max": self.published_max,
+                "quorum": {
+                    "required": self.published_required,
+                    "present": self.state.quorum.members,
+                    "attendees": self.state.quorum.attendees,
+                    "proxies": self.state.quorum.proxies,
+                },
+            })
+        return self.snapshot_frame
+
+    def frames_since(self, version: int) -> typing.List[str]:
+        """Returns the frames a websocket at a given version needs to catch up: the deltas since then if we still
+        have them, a snapshot otherwise."""
+        if version and self.log and self.log[0][0] <= version + 1:
+            return [frame for entry_version, frame in self.log if entry_version > version]
+        return [self.snapshot()]
+
+    def tick(self):
+        """Expires absent users and rebuilds the frames if anything changed, or every PRESENCE_RESEND ticks"""
+        if self.touched:  # Let other workers know who is connected here
+            self.state.bus.publish("presence", list(self.touched), local=False)
+            self.touched.clear()
+        self.expire()
+        if self.changed or self.quorum_version != self.state.quorum.version or self.ticks % PRESENCE_RESEND == 0:
+            self.update()
+        self.ticks += 1
+
+    async def run(self):
+        """Runs the presence ticker, once every PRESENCE_INTERVAL seconds"""
+        while True:
+            self.tick()
+            await asyncio.sleep(PRESENCE_INTERVAL)
+
+
+class Roster:
+    """The list of current ASF members. Loaded from an on-disk cache at startup, and refreshed in the background
+    using conditional requests. The member set is replaced as a whole, never modified in place."""
+
+    def __init__(self, url: str, cache_file: str, refresh_interval: int):
+        self.url = url
+        self.cache_file = cache_file
+        self.refresh_interval = refresh_interval
+        self.members: frozenset = frozenset()
+        self.etag = None
+        self.last_modified = None
+        if os.path.isfile(self.cache_file):
+            try:
+                with open(self.cache_file) as f:
+                    cache = json.load(f)
+                self.members = frozenset(cache["members"])
+                self.etag = cache.get("etag")
+                self.last_modified = cache.get("last_modified")
+                print(f"Loaded {len(self.members)} members from {self.cache_file}")
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Could not load member roster cache {self.cache_file}: {e}")
+
+    def save(self, members: list):
+        """Writes the roster to the on-disk cache, replacing the old file in one go"""
+        tmp_file = self.cache_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"members": members, "etag": self.etag, "last_modified": self.last_modified}, f)
+        os.replace(tmp_file, self.cache_file)
+
+    async def refresh(self) -> bool:
+        """Fetches the member list if it has changed since last time. Returns True if it was updated."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        timeout = aiohttp.ClientTimeout(total=30)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.get(self.url, headers=headers) as response:
+                if response.status == 304:  # Not modified
+                    return False
+                response.raise_for_status()
+                members = (await response.json(content_type=None))["members"]
+                self.etag = response.headers.get("ETag")
+                self.last_modified = response.headers.get("Last-Modified")
+        self.members = frozenset(members)
+        print(f"Refreshed member roster, {len(self.members)} members")
+        try:
+            await asyncio.to_thread(self.save, members)
+        except OSError as e:
+            print(f"Could not write member roster cache {self.cache_file}: {e}")
+        return True
+
+    async def run(self):
+        """Refreshes the roster every refresh_interval seconds"""
+        while True:
+            try:
+                await self.refresh()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+                print(f"Could not refresh member roster from {self.url}: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+
+def header_qualities(value: str) -> typing.Dict[str, float]:
+    """Parses a list of tokens with optional quality values (like Accept-Encoding) into a token -> quality dict"""
+    qualities = {}
+    for item in value.split(","):
+        token, *parameters = item.split(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        quality = 1.0
+        for parameter in parameters:
+            name, _, number = parameter.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0.0
+        qualities[token] = quality
+    return qualities
+
+
+def etag_matches(value: str, etag: str) -> bool:
+    """Checks whether an If-None-Match header (a list of ETags, or *) matches an ETag, using weak comparison"""
+    tags = [tag.strip() for tag in value.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+class StaticAsset:
+    """A single static file from htdocs, with precompressed variants and caching metadata"""
+
+    def __init__(self, path: str, data: bytes, mtime: float, immutable: bool = False):
+        self.path = path
+        self.data = data
+        self.mtime = mtime
+        self.immutable = immutable  # Fingerprinted URLs never change, so they can be cached forever
+        self.content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.etag = '"%s"' % hashlib.sha256(data).hexdigest()[:32]
+        self.variants = {}  # Content-Encoding -> compressed data
+        self.etags = {None: self.etag}  # Content-Encoding -> ETag, as every encoding is a different representation
+        if self.content_type.startswith("text/") or self.content_type in COMPRESSIBLE_TYPES:
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(compressed) < len(data):
+                self.variants["gzip"] = compressed
+            if brotli:
+                compressed = brotli.compress(data)
+                if len(compressed) < len(data):
+                    self.variants["br"] = compressed
+        for encoding, suffix in (("gzip", "-gz"), ("br", "-br")):
+            if encoding in self.variants:
+                self.etags[encoding] = self.etag[:-1] + suffix + '"'
+
+    def response(self, headers) -> quart.Response:
+        """Returns the response for this asset, honoring If-None-Match and Accept-Encoding"""
+        accepted = header_qualities(headers.get("Accept-Encoding", ""))
+        encoding = None
+        best = 0.0
+        for candidate in ("br", "gzip"):  # In order of preference, if the client likes them equally
+            quality = accepted.get(candidate, accepted.get("*", 0.0))
+            if candidate in self.variants and quality > best:
+                encoding, best = candidate, quality
+        response_headers = {
+            "ETag": self.etags[encoding],
+            "Cache-Control": "public, max-age=31536000, immutable" if self.immutable else "no-cache",
+            "Vary": "Accept-Encoding",
+        }
+        if etag_matches(headers.get("If-None-Match", ""), self.etags[encoding]):
+            return quart.Response(b"", status=304, headers=response_headers)
+        if encoding:
+            response_headers["Content-Encoding"] = encoding
+            return quart.Response(self.variants[encoding], content_type=self.content_type, headers=response_headers)
+        return quart.Response(self.data, content_type=self.content_type, headers=response_headers)
+
+
+class StaticAssets:
+    """In-memory cache of everything in htdocs. Files are reloaded when they change on disk, which is checked
+    at most once every ASSET_RECHECK_INTERVAL seconds. JS and CSS files listed in FINGERPRINTED_ASSETS are also
+    served under a URL containing their checksum, and HTML files are rewritten to point to those URLs."""
+
+    def __init__(self, root: str = "htdocs"):
+        self.root = root
+        self.assets: dict = {}  # URL path -> StaticAsset
+        self.mtimes: dict = {}  # Disk path -> mtime, for noticing changes
+        self.last_check = 0
+        self.load()
+
+    def scan(self) -> dict:
+        """Returns the mtime of every file in the root directory"""
+        mtimes = {}
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                filepath = os.path.join(directory, filename)
+                mtimes[filepath] = os.stat(filepath).st_mtime
+        return mtimes
+
+    def load(self):
+        """(Re)loads all assets from disk"""
+        self.mtimes = self.scan()
+        self.last_check = time.time()
+        assets = {}
+        fingerprints = {}  # Original URL -> fingerprinted URL
+        html_files = []
+        for filepath, mtime in self.mtimes.items():
+            path = "/" + os.path.relpath(filepath, self.root).replace(os.sep, "/")
+            with open(filepath, "rb") as f:
+                data = f.read()
+            if path.endswith(".html"):
+                html_files.append((path, data, mtime))
+                continue
+            assets[path] = StaticAsset(path, data, mtime)
+            if path in FINGERPRINTED_ASSETS:
+                base, extension = os.path.splitext(path)
+                fingerprinted = f"{base}.{assets[path].etag[1:9]}{extension}"
+                assets[fingerprinted] = StaticAsset(fingerprinted, data, mtime, immutable=True)
+                fingerprints[path] = fingerprinted
+        for path, data, mtime in html_files:
+            for original, fingerprinted in fingerprints.items():
+                data = re.sub(rb'(["\'])%s(\?[^"\']*)?\1' % re.escape(original.encode()), b"\\1%s\\1" % fingerprinted.encode(), data)
+            assets[path] = StaticAsset(path, data, mtime)
+        self.assets = assets
+
+    def reload(self):
+        """Reloads all assets if any file has changed on disk"""
+        if self.scan() != self.mtimes:
+            print("Static files have changed on disk, reloading")
+            self.load()
+
+    async def get(self, path: str) -> typing.Optional[StaticAsset]:
+        """Returns the asset for a URL path, or None if there is no such file"""
+        if time.time() - self.last_check > ASSET_RECHECK_INTERVAL:
+            self.last_check = time.time()
+            # Reading and compressing files takes a while, so do that in a thread. Requests coming in meanwhile
+            # get the assets as they were, as the new set is swapped in all at once.
+            await asyncio.to_thread(self.reload)
+        if path.endswith("/"):
+            path += "index.html"
+        return self.assets.get(path)
 
 
 class State:
@@ -134,24 +2071,183 @@ class State:
     def __init__(self):
         self.config: dict = yaml.safe_load(open("mm.yaml"))
         self.admins = self.config.get("admins", [])
-        self.rooms: list = []
-        self.pending_messages: dict = {}
+        self.rooms: dict = {}  # room name -> ChatRoom
+        self.positions: dict = {}  # message key -> (ChatRoom, HistoryChunk or None for the tail, index), for redaction
+        self.assets = StaticAssets("htdocs")
+        self.subscribers: dict = {}  # websocket id -> Outbox of frames pending delivery
+        self.connections: dict = {}  # uid -> websocket ids of that user
+        self.metrics = Metrics()
+        self.metrics.describe("asfmm_messages_total", "counter", "Chat messages posted, per room (use rate() for messages per second)")
+        self.metrics.describe("asfmm_fanout_seconds", "histogram", "Time from posting a message until it was sent to the last websocket")
+        self.metrics.describe("asfmm_db_write_seconds", "histogram", "Time taken to commit a batch of writes to the database")
+        self.metrics.describe("asfmm_db_writes_total", "counter", "Rows written to the database")
+        self.metrics.describe("asfmm_event_loop_lag_seconds", "histogram", "How late the event loop was in running a scheduled task")
+        self.metrics.describe("asfmm_history_replay_seconds", "histogram", "Time taken to send the chat history to a websocket when it connects")
+        self.metrics.describe("asfmm_export_seconds", "histogram", "Time taken to produce and send an export")
+        self.metrics.describe("asfmm_search_seconds", "histogram", "Time taken to run a full-text search of the chat history")
+        self.metrics.gauge("asfmm_websockets", "Open websocket connections", lambda: len(self.subscribers))
+        self.metrics.gauge("asfmm_outbox_depth", "Frames waiting to be sent, across all websockets", lambda: self.outbox_stats()["depth"])
+        self.metrics.gauge("asfmm_outbox_max_depth", "Frames waiting to be sent to the slowest websocket", lambda: self.outbox_stats()["max_depth"])
+        self.metrics.gauge("asfmm_outbox_dropped", "Frames dropped because a websocket could not keep up", lambda: self.outbox_stats()["dropped"], "counter")
+        self.metrics.gauge("asfmm_outbox_disconnects", "Websockets disconnected because they could not keep up", lambda: self.outbox_stats()["disconnects"], "counter")
+        self.metrics.gauge("asfmm_db_write_queue", "Writes waiting to be committed to the database", lambda: self.db_writer.queue.qsize())
+        self.outbox_size = self.config.get("outbox", {}).get("size", DEFAULT_OUTBOX_SIZE)
+        self.outbox_policy = self.config.get("outbox", {}).get("policy", "drop_oldest")
+        self.outbox_dropped = 0  # Frames dropped by outboxes of websockets that have since closed
+        self.outbox_disconnects = 0  # Number of websockets disconnected for not keeping up
         self.attendees: dict = {}
         self.quorum: set = set()
-        self.invites: dict = {}
         db_name = self.config["database"]
         print(f"Opening database {db_name}")
         self.db: asfpy.sqlite.DB = asfpy.sqlite.DB(db_name)
-        self.blocked: list = []
-        self.banned: list = []
-        self.members = requests.get(self.config["quorum"]["json_url"]).json()['members']
-        self.quorum = Quorum(self.db)
+        self.db.runc("PRAGMA journal_mode=WAL")  # Lets us keep reading while the writer thread commits
+        self.db_writer = DBWriter(db_name, self.metrics)
+        cluster = self.config.get("cluster", {})
+        if cluster.get("backend", "local") == "unix":
+            self.bus: EventBus = UnixSocketBus(cluster.get("socket", "asfmm.sock"))
+        else:
+            self.bus: EventBus = EventBus()
+        self.bus.subscribe("message", self.on_message)
+        self.bus.subscribe("redact", self.on_redact)
+        self.moderation = Moderation(self.db, self.db_writer, self.bus)
+        self.moderation.subscribe(self.on_moderation)
+        self.roster = Roster(
+            self.config["quorum"]["json_url"],
+            self.config["quorum"].get("cache_file", "members.json"),
+            self.config["quorum"].get("refresh_interval", 600),
+        )
+        self.quorum = Quorum(self.db, self.db_writer, self.bus)
+        self.invites = Invites(
+            self.db,
+            self.db_writer,
+            db_name,
+            self.bus,
+            self.config.get("invites", {}).get("ttl", DEFAULT_INVITE_TTL),
+            self.config.get("invites", {}).get("quota", DEFAULT_INVITE_QUOTA),
+        )
+        self.presence = Presence(self)
+        self.limiter = RateLimiter(self.config)
+        self.profiler = Profiler()
+        self.tracer = Tracer(
+            self.bus,
+            self.config.get("tracing", {}).get("slow_request", DEFAULT_SLOW_REQUEST),
+            self.config.get("tracing", {}).get("slow_callback", DEFAULT_SLOW_CALLBACK),
+        )
 
         print(f"Loaded {len(self.quorum.members)} attendees from quorum table")
 
-        if not self.db.table_exists("messages"):
-            print("Creating DB table for messages")
-            self.db.runc(DB_CREATE_MESSAGES)
+        storage = self.config.get("storage", {})
+        if storage.get("backend", "sqlite") == "log":
+            print(f"Storing messages in segmented logs under {storage.get('path', 'messages')}")
+            self.store: MessageStore = LogStore(
+                storage.get("path", "messages"),
+                storage.get("segment_size", DEFAULT_SEGMENT_SIZE),
+                db_writer=self.db_writer,
+            )
+        else:
+            self.store: MessageStore = SQLiteStore(self.db, self.db_writer, db_name)
+        self.search = SearchIndex(self.db if isinstance(self.store, SQLiteStore) else None, db_name)
 
         for room, data in self.config["channels"].items():
-            self.rooms.append(ChatRoom(self, room, data["name"], data["topic"]))
+            self.rooms[room] = ChatRoom(self, room, data["name"], data["topic"])
+
+    @property
+    def members(self) -> frozenset:
+        """The current set of ASF members"""
+        return self.roster.members
+
+    def broadcast(self, frame: str, track: bool = False):
+        """Sends an encoded frame to every websocket subscriber. If track is set, the time it takes
+        to reach every subscriber is recorded in the fan-out latency histogram."""
+        fanout = Fanout(self.metrics, len(self.subscribers)) if track and self.subscribers else None
+        for outbox in self.subscribers.values():  # Wake up every websocket waiting for messages
+            outbox.put(frame, fanout)
+
+    def subscribe(self, hashuid: uuid.UUID, task: asyncio.Task, uid: str) -> Outbox:
+        """Creates the outbox for a new websocket of a user"""
+        outbox = self.subscribers[hashuid] = Outbox(self.outbox_size, self.outbox_policy, task, uid)
+        self.connections.setdefault(uid, set()).add(hashuid)
+        return outbox
+
+    def unsubscribe(self, hashuid: uuid.UUID):
+        """Removes the outbox of a closed websocket, keeping track of how it fared"""
+        outbox = self.subscribers.pop(hashuid)
+        outbox.sent()
+        outbox.discard()  # Anything not sent by now never will be
+        self.outbox_dropped += outbox.dropped
+        if outbox.closed == "slow":
+            self.outbox_disconnects += 1
+        connections = self.connections.get(outbox.uid)
+        if connections:
+            connections.discard(hashuid)
+            if not connections:
+                del self.connections[outbox.uid]
+
+    def outbox_stats(self) -> dict:
+        """Returns queue depth and drop counters across all websocket outboxes"""
+        outboxes = list(self.subscribers.values())
+        return {
+            "connections": len(outboxes),
+            "depth": sum(len(outbox) for outbox in outboxes),
+            "max_depth": max((len(outbox) for outbox in outboxes), default=0),
+            "peak_depth": max((outbox.peak for outbox in outboxes), default=0),
+            "dropped": self.outbox_dropped + sum(outbox.dropped for outbox in outboxes),
+            "disconnects": self.outbox_disconnects,
+        }
+
+    def post(self, sender: str, realname: str, roomname: str, message: str) -> dict:
+        """Posts a message to a room on behalf of a user, if they are allowed to. Returns the response for the client."""
+        if self.moderation.is_muted(sender):
+            return {
+                "success": False,
+                "message": "You appear to be blocked from sending messages",
+            }
+        room = self.rooms.get(roomname) if isinstance(roomname, str) else None
+        if room is None:
+            return {
+                "success": False,
+                "message": "Could not find room!",
+            }
+        if not isinstance(message, str) or not message:  # Anything else would end up in everyone's history
+            return {
+                "success": False,
+                "message": "Invalid request",
+            }
+        refusal = self.limiter.check(roomname, sender, len(self.subscribers))
+        if refusal:
+            return {
+                "success": False,
+                "message": refusal,
+            }
+        room.add_message(sender, realname, message)
+        return {
+            "success": True,
+            "message": "Message sent!",
+        }
+
+    def on_message(self, row: dict):
+        """Adds a new message (posted in this or another worker) to its room"""
+        room = self.rooms.get(row["room"])
+        if room is not None:
+            room.append(Message.from_row(row))
+
+    def redact(self, msgid: str):
+        """Redacts a message from storage and from memory in every worker"""
+        self.store.redact(msgid)  # Older messages may only be in storage, so always do this
+        self.bus.publish("redact", msgid)
+
+    def on_redact(self, msgid: str):
+        """Removes a redacted message from memory, and tells all clients to remove it"""
+        position = self.positions.get(message_key(msgid))
+        if position:
+            position[0].redact(msgid)
+        self.broadcast(json_encode({"redact": msgid}))
+
+    def on_moderation(self, action: str, who: str):
+        """Disconnects banned users right away, and pushes the new moderation lists to admins"""
+        if action == "ban":
+            for hashuid in list(self.connections.get(who, ())):
+                self.subscribers[hashuid].close("banned")
+        for admin in self.admins:
+            for hashuid in self.connections.get(admin, ()):
+                self.subscribers[hashuid].put(self.moderation.frame, snapshot="moderation")
@@ -275,6 +275,16 @@ const URL_RE = new RegExp("(" + "(?:(?:[a-z]+)://)" + "(?:\\S+(?::\\S*)?@)?" + "
 let wscon = null;
 let tribute;
 let nicks = [];
+let last_timestamp = 0;  // Timestamp of the most recent message we have seen
+let reconnect_attempts = 0;
+let oldest_timestamp = {};  // Timestamp of the oldest message we have, per channel, for fetching older history
+let history_loading = {};
+let history_exhausted = {};
+let presence_version = 0;  // Version of the presence data we have, deltas from the server build on this
+let presence_resync = false;  // Set when we have asked the server for a presence snapshot
+let resyncing = false;  // Set when we are reconnecting to fetch messages we missed
+let post_id = 0;  // Id of the last message posted over the websocket
+let pending_posts = {};  // Post id -> message field, for showing errors when the server acks the post
 
 // Grabs credentials or goes to oauth screen
 async function get_preferences(formdata) {
@@ -328,11 +338,12 @@ function write_creds() {
     if (prefs.admin) {
         //document.getElementById('sidebar').style.width = '290px';
     }
+    const statuses = prefs.statuses || {blocked: [], banned: []};  // Pushed to admins by the server
     for (let user of current_people) {
         let udiv = new HTML('li', {}, user);
         if (prefs.admin && user !== prefs.credentials.uid) {
             // muted user
-            if (prefs.statuses.blocked.has(user)) {
+            if (statuses.blocked.has(user)) {
                 udiv.style.color = 'grey';
                 udiv.title = "User muted - cannot post";
                 let block = new HTML('a', {href: `javascript:void(unblock_user('${user}'));`, style: { marginLeft: '6px', float: 'right'}}, 'unmute');
@@ -342,7 +353,7 @@ function write_creds() {
                 udiv.inject(block);
             }
             // banned user
-            if (prefs.statuses.banned.has(user)) {
+            if (statuses.banned.has(user)) {
                 udiv.style.color = 'red';
                 udiv.title = "User banned - cannot read or post";
                 let ban = new HTML('a', {href: `javascript:void(unban_user('${user}'));`, style: { marginLeft: '6px', float: 'right'}}, 'unban');
@@ -390,7 +401,6 @@ async function block_user(who) {
         action: 'block',
         user: who
     });
-    prefs.statuses['blocked'].push(who);
     let rv = await resp.json();
     alert(rv.message)
     write_creds();
@@ -401,7 +411,6 @@ async function ban_user(who) {
         action: 'ban',
         user: who
     });
-    prefs.statuses['banned'].push(who);
     let rv = await resp.json();
     alert(rv.message)
     write_creds();
@@ -412,7 +421,6 @@ async function unblock_user(who) {
         action: 'unblock',
         user: who
     });
-    prefs.statuses['blocked'].remove(who);
     let rv = await resp.json();
     alert(rv.message)
     write_creds();
@@ -423,7 +431,6 @@ async function unban_user(who) {
         action: 'unban',
         user: who
     });
-    prefs.statuses['banned'].remove(who);
     let rv = await resp.json();
     alert(rv.message)
     write_creds();
@@ -496,6 +503,26 @@ function assign_proxies() {
     let btn = new HTML('button', {onclick: 'send_proxies();'}, 'Submit');
     text.inject(new HTML('br'));
     text.inject(btn);
+    // Admins can also load a whole list of proxies (plain list or CSV, member ID first) from a file
+    if (prefs.admin) {
+        text.inject(new HTML('br'));
+        text.inject(new HTML('br'));
+        text.inject("Or upload a list of proxies (one member ID per line, or a CSV file with the ID in the first column): ");
+        text.inject(new HTML('input', {type: 'file', id: 'proxy_file', accept: '.csv,.txt,text/csv,text/plain'}));
+        text.inject(new HTML('button', {onclick: 'upload_proxies();'}, 'Upload'));
+    }
+}
+
+
+async function upload_proxies() {
+    const file = document.getElementById('proxy_file').files[0];
+    if (!file) return;
+    const resp = await POST("/proxy/upload", {
+        text: await file.text()
+    });
+    let text = document.getElementById('modal_text');
+    let rv = await resp.json();
+    text.innerText = rv.message
 }
 
 
@@ -526,18 +553,30 @@ async function main() {
 async function chat() {
     const prot = (location.protocol == 'https:') ? 'wss://' : 'ws://';
     const port = (location.port == "") ? "" : ":" + location.port;
-    wscon = new WebSocket(prot + location.hostname + port + '/chat');
-    // Connection killed
+    // If we are reconnecting, only ask for what we missed since the last message we saw
+    const since = last_timestamp ? `?since=${last_timestamp}` : '';
+    // Ask for MessagePack frames, the server falls back to JSON if it cannot do that
+    wscon = new WebSocket(prot + location.hostname + port + '/chat' + since, ['asfmm.msgpack', 'asfmm.json']);
+    wscon.binaryType = 'arraybuffer';
+    // Connection killed, try to reconnect after a little while. Spread out reconnections so
+    // not every client comes knocking at the same time after a blip.
+    wscon.addEventListener('open', function (event) {
+        reconnect_attempts = 0;
+    });
     wscon.addEventListener('close', function (event) {
-        if (!event.wasClean) {
-            alert("Connection was lost, reconnecting..!");
-            location.reload();
+        if (resyncing) {  // We closed the connection to fetch messages we missed, reconnect right away
+            resyncing = false;
+            chat();
+        }
+        else if (!event.wasClean || event.code === 1013) {  // Lost connection, or the server told us to come back later
+            // If we keep failing, our session may have expired. Reload and let the OAuth gate sort it out.
+            if (++reconnect_attempts > 5) {
+                location.reload();
+                return
+            }
+            console.log("Connection was lost, reconnecting...");
+            window.setTimeout(chat, 1000 + (Math.random()*4000));
         }
-    });
-
-    wscon.addEventListener('error', function (event) {
-        alert("Connection was lost, reloading..!");
-        location.reload();
     });
 
     window.onbeforeunload = function() {
@@ -546,106 +585,283 @@ async function chat() {
     }
     // Listen for messages
     wscon.addEventListener('message', function (event) {
-        const js = JSON.parse(event.data);
+        if (resyncing) return;  // Anything after a gap will be sent again once we reconnect
+        const js = (typeof event.data === 'string') ? JSON.parse(event.data) : expand_fields(unpack_frame(event.data));
+        if (js.gap) {
+            // We were too slow and the server dropped some messages. Reconnect and fetch everything since
+            // the last message we saw. Messages we already have are skipped.
+            console.log(`Missed ${js.gap} messages, resyncing...`);
+            resyncing = true;
+            wscon.close();
+            return
+        }
         if (js.room_data) {
+            if (rooms.find((room) => room.id === js.room_data.id)) return;  // Already known, we are reconnecting
             js.room_data.unread = 0;
             rooms.push(js.room_data);
             current_room = rooms[0].id;
             show_channel(current_room)
             console.log(js.room_data);
         }
-        if (js.channel) {
-            let channeldiv = document.getElementById('channel_' + js.channel);
-            if (!channeldiv) channeldiv =  mkchannel(js.channel);
-            const now = moment(js.timestamp * 1000.0).fromNow();
-            let messagediv = new HTML('div', {class: 'message'});
-            let dateinner = new HTML('span', {}, now);
-            let datediv = new HTML('div', {class: 'timestamp', tz: js.timestamp*1000.0}, dateinner);
-            // Update timestamp every 30-40 seconds..ish. Random distribution of load
-            window.setInterval(() => dateinner.innerText = moment(parseFloat(datediv.getAttribute('tz'))).fromNow(), 30000 + (Math.random()*10000));
-            datediv.title = new Date(js.timestamp * 1000.0).toString();
-            let namediv = new HTML('div', {class: 'name'}, `${js.realname} (${js.sender})`);
-            namediv.title = namediv.innerText;
-            if (js.timestamp == 0) {
-                datediv.innerText = '';
-                namediv.innerText = '';
-                messagediv.style.color = 'navy';
-                messagediv.style.fontWeight = 'bold';
-            }
-
-            let is_action = false;
-            if (js.message.match(/^\/me /)) {
-                js.message = js.message.substr(4);
-                is_action = true;
-            }
-            // [off] needs to be marked as such
-            if (js.message.match(/^\s*\[off\]\s*/)) {
-                messagediv.setAttribute('class', 'message_off');
-            }
-            let parsed = fixup_urls(js.message);
-            parsed = fixup_formatting(parsed, /\b__(.+?)__\b/, "b");
-            parsed = fixup_formatting(parsed, /\b_(.+?)_\b/, "i");
-            parsed = fixup_formatting(parsed, /(?=[\s^])?\*\*(.+?)\*\*(?=[\s$])?/, "b");
-            parsed = fixup_formatting(parsed, /(?=[\s^])?\*(.+?)\*(?=[\s$])?/, "i");
-            parsed = fixup_formatting(parsed, "`(.+?)`", "kbd");
-
-            messagediv.inject(parsed);
-            if (is_action) {
-                messagediv.style.fontStyle = 'italic';
-                messagediv.style.color = 'blue';
-            }
-            if (js.message.match('@' + prefs.credentials.login + "\\b")) {
-                messagediv.style.fontWeight = 'bolder';
-                messagediv.style.color = '#3443e8';
-            }
-            let linediv = new HTML('div', {class: 'line', id: js.msgid});
-            linediv.inject(namediv);
-            linediv.inject(datediv);
-            linediv.inject(messagediv);
-            let scroll_to_bottom = Math.floor(channeldiv.scrollHeight - channeldiv.offsetHeight) - Math.floor(channeldiv.scrollTop) < 5 ? true : false;
-            channeldiv.inject(linediv);
-            if (scroll_to_bottom) {  // Only scroll if we are at the bottom already.
-                channeldiv.scrollTo(0, channeldiv.scrollHeight);
-            }
-
-            // Notify on mention??
-            if (js.message.match('@' + prefs.credentials.login + "\\b") && notify_user) {
-                notify(js.channel, js.realname, js.message);
-            }
-
-            // Admin? If so, add a redact option to the message
-            if (prefs.admin) {
-                datediv.inject(new HTML('a', {style: {marginLeft: '10px'}, href: `javascript:void(redact('${js.msgid}'));`}, 'Redact'))
-            }
-
-            if (js.channel != current_room) {
-                for (room of rooms) {
-                    if (room.id == js.channel && js.timestamp) {
-                        room.unread++;
-                        let urdiv = document.getElementById('unread_' + room.id);
-                        urdiv.innerText = room.unread;
-                    }
-                }
+        if (js.history) {
+            for (let message of js.history) {
+                show_message(message);
             }
         }
+        else if (js.channel) {
+            show_message(js);
+        }
+        else if (js.ack !== undefined) {  // Result of a message we posted over the websocket
+            const el = pending_posts[js.ack];
+            delete pending_posts[js.ack];
+            if (el && !js.success) el.value = js.message;
+        }
+        else if (js.moderation) {  // Admins only: the current lists of blocked and banned users
+            prefs.statuses = js.moderation;
+            write_creds();
+        }
+        else if (js.redact) {
+            const linediv = document.getElementById(js.redact);
+            if (linediv) linediv.parentNode.removeChild(linediv);
+        }
         else if (js.pong) {
             notify_block = false;
             attendees = js.attendees;
             max_people = js.max;
             current_people = js.current;
             current_people.sort((a, b) => a.localeCompare(b));
-            prefs.statuses = js.statuses;
             prefs.quorum = js.quorum;
+            presence_version = js.version;
+            presence_resync = false;
+            write_creds();
+        }
+        else if (js.delta) {  // Only what changed since the previous presence update
+            if (presence_resync) return;  // Waiting for a snapshot
+            if (js.delta !== presence_version + 1) {  // We missed an update, ask for everything again
+                presence_resync = true;
+                wscon.send(JSON.stringify({action: 'resync'}));
+                return
+            }
+            presence_version = js.delta;
+            notify_block = false;
+            if (js.joined) current_people = current_people.concat(js.joined.filter((uid) => !current_people.includes(uid)));
+            if (js.left) current_people = current_people.filter((uid) => !js.left.includes(uid));
+            current_people.sort((a, b) => a.localeCompare(b));
+            attendees = current_people.length;
+            if (js.max !== undefined) max_people = js.max;
+            let quorum = prefs.quorum;
+            if (js.required !== undefined) quorum.required = js.required;
+            for (const uid of js.attended || []) {
+                if (!quorum.attendees.includes(uid)) quorum.attendees.push(uid);
+                quorum.proxies = quorum.proxies.filter((proxy) => proxy !== uid);
+                if (!quorum.present.includes(uid)) quorum.present.push(uid);
+            }
+            for (const uid of js.proxied || []) {
+                if (!quorum.attendees.includes(uid) && !quorum.proxies.includes(uid)) quorum.proxies.push(uid);
+                if (!quorum.present.includes(uid)) quorum.present.push(uid);
+            }
             write_creds();
         }
     });
 }
 
+// Field names are sent as short codes in MessagePack frames. These need to match FIELD_CODES in classes.py
+const FIELD_NAMES = {
+    i: 'msgid', t: 'timestamp', c: 'channel', s: 'sender', r: 'realname', m: 'message', h: 'history',
+    d: 'room_data', n: 'id', T: 'title', o: 'topic', R: 'redact', k: 'ack', u: 'success', g: 'gap',
+    p: 'pong', C: 'current', a: 'attendees', x: 'max', q: 'quorum', Q: 'required',
+    P: 'present', y: 'proxies', b: 'blocked', B: 'banned', M: 'moderation', v: 'version', D: 'delta', j: 'joined',
+    l: 'left', A: 'attended', Y: 'proxied'
+};
+
+// Restores the full field names in a frame decoded from MessagePack
+function expand_fields(obj) {
+    if (Array.isArray(obj)) return obj.map(expand_fields);
+    if (obj === null || typeof obj !== 'object') return obj;
+    let expanded = {};
+    for (const [key, value] of Object.entries(obj)) {
+        expanded[FIELD_NAMES[key] || key] = expand_fields(value);
+    }
+    return expanded;
+}
+
+// Minimal MessagePack decoder, covering the types the server sends
+function unpack_frame(buffer) {
+    const view = new DataView(buffer);
+    const bytes = new Uint8Array(buffer);
+    const decoder = new TextDecoder();
+    let pos = 0;
+    function advance(count, result) {
+        pos += count;
+        return result;
+    }
+    function str(length) {
+        return advance(length, decoder.decode(bytes.subarray(pos, pos + length)));
+    }
+    function bin(length) {
+        return advance(length, bytes.slice(pos, pos + length));
+    }
+    function array(length) {
+        let items = [];
+        for (let i = 0; i < length; i++) items.push(read());
+        return items;
+    }
+    function map(length) {
+        let items = {};
+        for (let i = 0; i < length; i++) {
+            const key = read();
+            items[key] = read();
+        }
+        return items;
+    }
+    function read() {
+        const type = bytes[pos++];
+        if (type < 0x80) return type;  // positive fixint
+        if (type < 0x90) return map(type & 0x0f);  // fixmap
+        if (type < 0xa0) return array(type & 0x0f);  // fixarray
+        if (type < 0xc0) return str(type & 0x1f);  // fixstr
+        if (type >= 0xe0) return type - 0x100;  // negative fixint
+        switch (type) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: return bin(advance(1, view.getUint8(pos)));
+            case 0xc5: return bin(advance(2, view.getUint16(pos)));
+            case 0xc6: return bin(advance(4, view.getUint32(pos)));
+            case 0xca: return advance(4, view.getFloat32(pos));
+            case 0xcb: return advance(8, view.getFloat64(pos));
+            case 0xcc: return advance(1, view.getUint8(pos));
+            case 0xcd: return advance(2, view.getUint16(pos));
+            case 0xce: return advance(4, view.getUint32(pos));
+            case 0xcf: return advance(8, Number(view.getBigUint64(pos)));
+            case 0xd0: return advance(1, view.getInt8(pos));
+            case 0xd1: return advance(2, view.getInt16(pos));
+            case 0xd2: return advance(4, view.getInt32(pos));
+            case 0xd3: return advance(8, Number(view.getBigInt64(pos)));
+            case 0xd9: return str(advance(1, view.getUint8(pos)));
+            case 0xda: return str(advance(2, view.getUint16(pos)));
+            case 0xdb: return str(advance(4, view.getUint32(pos)));
+            case 0xdc: return array(advance(2, view.getUint16(pos)));
+            case 0xdd: return array(advance(4, view.getUint32(pos)));
+            case 0xde: return map(advance(2, view.getUint16(pos)));
+            case 0xdf: return map(advance(4, view.getUint32(pos)));
+        }
+        throw new Error(`Unsupported MessagePack type 0x${type.toString(16)}`);
+    }
+    return read();
+}
+
+// Adds a single chat message to its channel. Older messages fetched from the history are put at the top.
+function show_message(js, older=false) {
+    if (document.getElementById(js.msgid)) return;  // Already seen this one
+    if (js.timestamp > last_timestamp) last_timestamp = js.timestamp;
+    if (!oldest_timestamp[js.channel] || js.timestamp < oldest_timestamp[js.channel]) oldest_timestamp[js.channel] = js.timestamp;
+    let channeldiv = document.getElementById('channel_' + js.channel);
+    if (!channeldiv) channeldiv =  mkchannel(js.channel);
+    const now = moment(js.timestamp * 1000.0).fromNow();
+    let messagediv = new HTML('div', {class: 'message'});
+    let dateinner = new HTML('span', {}, now);
+    let datediv = new HTML('div', {class: 'timestamp', tz: js.timestamp*1000.0}, dateinner);
+    // Update timestamp every 30-40 seconds..ish. Random distribution of load
+    window.setInterval(() => dateinner.innerText = moment(parseFloat(datediv.getAttribute('tz'))).fromNow(), 30000 + (Math.random()*10000));
+    datediv.title = new Date(js.timestamp * 1000.0).toString();
+    let namediv = new HTML('div', {class: 'name'}, `${js.realname} (${js.sender})`);
+    namediv.title = namediv.innerText;
+    if (js.timestamp == 0) {
+        datediv.innerText = '';
+        namediv.innerText = '';
+        messagediv.style.color = 'navy';
+        messagediv.style.fontWeight = 'bold';
+    }
+
+    let is_action = false;
+    if (js.message.match(/^\/me /)) {
+        js.message = js.message.substr(4);
+        is_action = true;
+    }
+    // [off] needs to be marked as such
+    if (js.message.match(/^\s*\[off\]\s*/)) {
+        messagediv.setAttribute('class', 'message_off');
+    }
+    let parsed = fixup_urls(js.message);
+    parsed = fixup_formatting(parsed, /\b__(.+?)__\b/, "b");
+    parsed = fixup_formatting(parsed, /\b_(.+?)_\b/, "i");
+    parsed = fixup_formatting(parsed, /(?=[\s^])?\*\*(.+?)\*\*(?=[\s$])?/, "b");
+    parsed = fixup_formatting(parsed, /(?=[\s^])?\*(.+?)\*(?=[\s$])?/, "i");
+    parsed = fixup_formatting(parsed, "`(.+?)`", "kbd");
+
+    messagediv.inject(parsed);
+    if (is_action) {
+        messagediv.style.fontStyle = 'italic';
+        messagediv.style.color = 'blue';
+    }
+    if (js.message.match('@' + prefs.credentials.login + "\\b")) {
+        messagediv.style.fontWeight = 'bolder';
+        messagediv.style.color = '#3443e8';
+    }
+    let linediv = new HTML('div', {class: 'line', id: js.msgid});
+    linediv.inject(namediv);
+    linediv.inject(datediv);
+    linediv.inject(messagediv);
+    if (older) {
+        channeldiv.insertBefore(linediv, channeldiv.firstChild);
+    } else {
+        let scroll_to_bottom = Math.floor(channeldiv.scrollHeight - channeldiv.offsetHeight) - Math.floor(channeldiv.scrollTop) < 5 ? true : false;
+        channeldiv.inject(linediv);
+        if (scroll_to_bottom) {  // Only scroll if we are at the bottom already.
+            channeldiv.scrollTo(0, channeldiv.scrollHeight);
+        }
+    }
+
+    // Admin? If so, add a redact option to the message
+    if (prefs.admin) {
+        datediv.inject(new HTML('a', {style: {marginLeft: '10px'}, href: `javascript:void(redact('${js.msgid}'));`}, 'Redact'))
+    }
+
+    if (older) return;  // Nothing new to notify about
+
+    // Notify on mention??
+    if (js.message.match('@' + prefs.credentials.login + "\\b") && notify_user) {
+        notify(js.channel, js.realname, js.message);
+    }
+
+    if (js.channel != current_room) {
+        for (room of rooms) {
+            if (room.id == js.channel && js.timestamp) {
+                room.unread++;
+                let urdiv = document.getElementById('unread_' + room.id);
+                urdiv.innerText = room.unread;
+            }
+        }
+    }
+}
+
+// Fetches the page of messages before the oldest one we have in a channel, when scrolling back
+async function load_older(chan) {
+    if (history_loading[chan] || history_exhausted[chan] || !oldest_timestamp[chan]) return;
+    history_loading[chan] = true;
+    const channeldiv = document.getElementById('channel_' + chan);
+    const resp = await GET(`/history?room=${encodeURIComponent(chan)}&before=${oldest_timestamp[chan]}`);
+    const js = await resp.json();
+    if (js.success) {
+        // Pages include messages at the timestamp we asked for, as several messages can share it
+        const fresh = js.history.filter(message => !document.getElementById(message.msgid));
+        if (!fresh.length) history_exhausted[chan] = true;
+        const height = channeldiv.scrollHeight;
+        for (let message of fresh.reverse()) {
+            show_message(message, true);
+        }
+        channeldiv.scrollTo(0, channeldiv.scrollHeight - height);  // Keep the view where it was
+    }
+    history_loading[chan] = false;
+}
+
 async function redact(msgid) {
     const resp = await POST("/mgmt", {action: 'redact', msgid: msgid});
     let rv = await resp.json();
     alert(rv.message);
-    if (rv.success) document.getElementById(msgid).parentNode.removeChild(document.getElementById(msgid));
+    const linediv = document.getElementById(msgid);
+    if (rv.success && linediv) linediv.parentNode.removeChild(linediv);
 }
 
 async function check_send(el, force=false) {
@@ -683,6 +899,13 @@ async function check_send(el, force=false) {
            }
         }
         el.value = '';
+        // Post over the websocket if we have it, fall back to a plain POST otherwise
+        if (wscon && wscon.readyState === WebSocket.OPEN) {
+            const id = ++post_id;
+            pending_posts[id] = el;
+            wscon.send(JSON.stringify({action: 'post', id: id, room: current_room, message: message}));
+            return
+        }
         let resp = await POST("/post", {
             room: current_room,
             message: message
@@ -703,6 +926,9 @@ function mkchannel(chan) {
         channeldiv.setAttribute('id', 'channel_' + chan);
         channeldiv.setAttribute('class', 'channel chat-history');
         if (chan != current_room) channeldiv.style.display = 'none';
+        channeldiv.addEventListener('scroll', () => {
+            if (channeldiv.scrollTop === 0) load_older(chan);
+        });
         let topic = '';
         for (let channel of rooms) {
             if (channel.id == chan) topic = `${channel.title}: ${channel.topic}`;
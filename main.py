@@ -21,35 +21,52 @@ import asfquart.generics
 import asfquart.session
 import quart
 import classes
-import os
+import asyncio
+import time
 
 # This forces the old style non-OIDC login.
 asfquart.generics.OAUTH_URL_INIT = "https://oauth.apache.org/auth?state=%s&redirect_uri=%s"
 asfquart.generics.OAUTH_URL_CALLBACK = "https://oauth.apache.org/token?code=%s"
 
 
-def htdocs_path(path):
-    """Returns the normalized path of a URI if it is within htdocs proper, otherwise None"""
-    if path.endswith("/"):
-        path += "index.html"
-    disk_path = os.path.join("htdocs", path[1:])  # htdocs + path without leading slash
-    if os.path.exists(disk_path) and os.path.normpath(disk_path).startswith("htdocs/"):
-        return path[1:]
-
-
 def asfmm_app():
     app = asfquart.construct("asfmm", oauth="/oauth_asf", force_login=False)
     app.state = classes.State()
+    app.add_runner(app.state.presence.run, name="presence")
+    app.add_runner(app.state.roster.run, name="roster")
+    app.add_runner(app.state.bus.run, name="bus")
+    app.add_runner(app.state.metrics.run, name="metrics")
+    app.add_runner(app.state.tracer.run, name="tracer")
+
+    @app.after_serving
+    async def shutdown():
+        """Makes sure all pending writes have made it to disk before we exit"""
+        await asyncio.to_thread(app.state.db_writer.close)
+        app.state.store.close()
+
+    @app.before_request
+    async def start_request_timer():
+        quart.g.request_started = time.monotonic()
+
+    @app.after_request
+    async def trace_slow_request(response):
+        """Logs requests that took longer than the slow request threshold"""
+        started = quart.g.get("request_started")
+        if started is not None:
+            app.state.tracer.request(quart.request.method, quart.request.path, time.monotonic() - started)
+        return response
+
     # TODO: arrange this more neatly.
-    from scripts import chat, export, invite, mgmt, post, proxy, preferences, oauth
+    from scripts import chat, export, history, invite, metrics, mgmt, post, proxy, preferences, oauth, search, debug
 
     # Static files (or index.html if requesting a dir listing)
     @app.route("/<path:path>")
     @app.route("/")
     async def static_files(path="index.html"):
-        disk_path = htdocs_path(quart.request.path)
-        if disk_path:
-            return await quart.send_from_directory("htdocs", disk_path)
+        asset = await app.state.assets.get(quart.request.path)
+        if asset:
+            return asset.response(quart.request.headers)
+        return quart.Response("Not found", status=404)
 
 
     return app
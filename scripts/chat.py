@@ -22,103 +22,134 @@ import asfquart.utils
 import typing
 import quart
 import asyncio
+import json
 import time
 import uuid
-import math
+import classes
 
 """ Chat interface via WebSockets """
 
-WEBSOCKET_TIMEOUT = 10  # After 10 seconds of no activity, we consider someone signed out.
-
 APP = asfquart.APP
 
 
+async def receive_posts(session: asfquart.session.ClientSession, outbox: classes.Outbox, resync: asyncio.Event):
+    """Handles messages posted by the client over the websocket. Each post carries a client-supplied id,
+    which is sent back along with the result, so the client can match them up. Clients can also ask for
+    a presence snapshot, if they missed a presence delta."""
+    while True:
+        data = await quart.websocket.receive()
+        try:
+            request = json.loads(data)
+        except (ValueError, TypeError):  # Not JSON, or a binary frame
+            request = None
+        if not isinstance(request, dict):
+            outbox.put(classes.json_encode({"ack": None, "success": False, "message": "Invalid request"}))
+            continue
+        if request.get("action") == "resync":
+            resync.set()
+            continue
+        if request.get("action") == "post":
+            try:
+                response = APP.state.post(session.uid, session.fullname, request.get("room"), request.get("message"))
+            except Exception as e:  # One bad post should not stop us from handling the next
+                print(f"Could not handle post from {session.uid}: {e}")
+                response = {"success": False, "message": "Invalid request"}
+        else:
+            response = {"success": False, "message": "Unknown action"}
+        response["ack"] = request.get("id")
+        outbox.put(classes.json_encode(response))
+
+
 @APP.websocket("/chat")
 @asfquart.auth.require
 async def process_chat() -> typing.Any:
     session = await asfquart.session.read()
     whoami = session.uid
-    if whoami in APP.state.banned:  # If banned, break and don't send messages at all
+    if whoami in APP.state.moderation.banned:  # If banned, break and don't send messages at all
         return {}
+    # Speak MessagePack if the client asks for it (and we can), JSON otherwise
+    protocol = None
+    for offered in classes.WIRE_PROTOCOLS:
+        if offered in quart.websocket.requested_subprotocols and (offered != "asfmm.msgpack" or classes.msgpack):
+            protocol = offered
+            break
+    await quart.websocket.accept(subprotocol=protocol)
+    if protocol == "asfmm.msgpack":
+
+        async def send(frame: str):
+            await quart.websocket.send(classes.pack_frame(frame))
+
+    else:
+        send = quart.websocket.send
+    try:
+        since = float(quart.websocket.args.get("since", 0))
+    except ValueError:
+        since = 0
     hashuid = uuid.uuid4()
-    APP.state.pending_messages[hashuid] = []
+    outbox = APP.state.subscribe(hashuid, asyncio.current_task(), whoami)
+    if whoami in APP.state.moderation.banned:  # Banned while we were connecting
+        outbox.close("banned")
+    resync = asyncio.Event()
+    receiver = asyncio.create_task(receive_posts(session, outbox, resync))
     try:
         # Init some vars for tracking
-        pongometer = 0
-        last_user_list = set()
-        # All history first
-        for room in APP.state.rooms:
-            await quart.websocket.send_json(
-                {
-                    "room_data": {
-                        "id": room.name,
-                        "title": room.title,
-                        "topic": room.topic,
-                    }
-                }
-            )
-            for message in room.messages:
-                await quart.websocket.send_json(
+        presence_version = 0
+        # All history first, or only what was posted after the client's last message if it is resuming
+        replay_start = time.monotonic()
+        for room in APP.state.rooms.values():
+            await send(
+                classes.json_encode(
                     {
-                        "msgid": message["uid"],
-                        "timestamp": message["timestamp"],
-                        "channel": message["room"],
-                        "sender": message["sender"],
-                        "realname": message["realname"],
-                        "message": message["message"],
+                        "room_data": {
+                            "id": room.name,
+                            "title": room.title,
+                            "topic": room.topic,
+                        }
                     }
                 )
-        # Now iterate over any new incoming messages, as well as status updates
+            )
+            for frame in room.history(since):
+                await send(frame)
+        APP.state.metrics.observe("asfmm_history_replay_seconds", time.monotonic() - replay_start)
+        if whoami in APP.state.admins:  # Admins get the moderation lists now, and again whenever they change
+            await send(APP.state.moderation.frame)
+        # Now sleep until new messages arrive, waking up for status updates every PRESENCE_INTERVAL seconds
+        next_presence = time.time()
         while True:
-            if whoami in APP.state.banned:  # If banned, break and don't send messages at all
-                return {}
-            if len(APP.state.pending_messages[hashuid]):
-                to_send = APP.state.pending_messages[hashuid].copy()  # copy to prevent race condition
-                APP.state.pending_messages[hashuid].clear()  # clear, so next iteration we only get new messages
-                for message in to_send:
-                    await quart.websocket.send_json(
-                        {
-                            "msgid": message["uid"],
-                            "timestamp": message["timestamp"],
-                            "channel": message["room"],
-                            "sender": message["sender"],
-                            "realname": message["realname"],
-                            "message": message["message"],
-                        }
-                    )
-            APP.state.attendees[whoami] = time.time()
-            if pongometer % 10 == 0:
-                currently_attending = set()
-                for k, v in APP.state.attendees.items():
-                    if v >= time.time() - WEBSOCKET_TIMEOUT:
-                        currently_attending.add(k)
-                # If user list has changed, or we've waited 7.5 seconds, re-send user list and statuses
-                if last_user_list != currently_attending or pongometer % 30 == 0:
-                    last_user_list = currently_attending
-                    statuses = {}
-                    if session.uid in APP.state.admins:
-                        statuses = {
-                            "blocked": APP.state.blocked,
-                            "banned": APP.state.banned,
-                        }
-                    await quart.websocket.send_json(
-                        {
-                            "pong": str(uuid.uuid4()),
-                            "statuses": statuses,
-                            "current": list(currently_attending),
-                            "attendees": len(currently_attending),
-                            "max": len(APP.state.attendees),
-                            "quorum": {
-                                "required": math.ceil(len(APP.state.members)/3),
-                                "present": APP.state.quorum.members,
-                                "attendees": APP.state.quorum.attendees,
-                                "proxies": APP.state.quorum.proxies
-                            }
-                        }
-                    )
-            pongometer += 1
-            await asyncio.sleep(0.25)
+            try:
+                frame = await asyncio.wait_for(outbox.get(), timeout=max(0, next_presence - time.time()))
+                if outbox.closed:
+                    raise asyncio.exceptions.CancelledError
+                await send(frame)
+                while frame := outbox.get_nowait():  # Send anything else that arrived in the meantime
+                    await send(frame)
+                continue
+            except asyncio.TimeoutError:
+                pass
+            next_presence = time.time() + classes.PRESENCE_INTERVAL
+            APP.state.presence.touch(whoami)
+            # If the presence service has new data for us, send what changed (or everything, if we are new or lost track)
+            if resync.is_set():
+                resync.clear()
+                presence_version = 0
+            version = APP.state.presence.version
+            if presence_version != version:
+                for frame in APP.state.presence.frames_since(presence_version):
+                    await send(frame)
+                presence_version = version
     except asyncio.exceptions.CancelledError:
-        pass
-    del APP.state.pending_messages[hashuid]
+        if outbox.closed == "banned":  # Policy violation, the client should not come back
+            print(f"Disconnecting {whoami}, who has been banned")
+            code, reason = 1008, "Banned"
+        elif outbox.closed:  # Could not keep up, tell the client to come back later
+            print(f"Disconnecting {whoami}, who could not keep up with the chat")
+            code, reason = 1013, "Too slow"
+        if outbox.closed:
+            try:
+                await asyncio.wait_for(quart.websocket.close(code, reason), timeout=1)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                pass
+    finally:
+        receiver.cancel()
+        APP.state.unsubscribe(hashuid)
     return {}
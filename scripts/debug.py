@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asfquart
+import asfquart.auth
+import asfquart.session
+import asfquart.utils
+import asyncio
+import quart
+import typing
+import classes
+
+"""Profiling and tracing end points for ASFMM"""
+
+APP = asfquart.APP
+
+
+@APP.route("/profile")
+@asfquart.auth.require()
+async def process_profile() -> typing.Any:
+    """Profiles this worker for a number of seconds, and returns the samples as collapsed stacks for a flame graph"""
+    session = await asfquart.session.read()
+    if session.uid not in APP.state.admins:
+        return quart.Response("You need administrative powers for this...", status=403)
+    formdata = await asfquart.utils.formdata()
+    try:
+        seconds = min(classes.PROFILE_MAX_SECONDS, max(0.1, float(formdata.get("seconds", 10))))
+        interval = min(1.0, max(0.001, float(formdata.get("interval", classes.PROFILE_INTERVAL))))
+    except ValueError:
+        return quart.Response("Invalid profiling parameters", status=400)
+    try:
+        stacks = await asyncio.to_thread(APP.state.profiler.profile, seconds, interval)
+    except RuntimeError as e:
+        return quart.Response(str(e), status=409)
+    return quart.Response(stacks, content_type="text/plain")
+
+
+@APP.route("/tracing", methods=["GET", "POST"])
+@asfquart.auth.require()
+async def process_tracing() -> typing.Any:
+    """Shows or changes the slow request and slow callback thresholds"""
+    session = await asfquart.session.read()
+    if session.uid not in APP.state.admins:
+        return {"success": False, "message": "You need administrative powers for this..."}
+    tracer = APP.state.tracer
+    if quart.request.method == "POST":
+        formdata = await asfquart.utils.formdata()
+        try:
+            thresholds = {name: float(formdata[name]) for name in ("slow_request", "slow_callback") if name in formdata}
+            tracer.configure(**thresholds)
+        except ValueError as e:
+            return {"success": False, "message": f"Invalid tracing thresholds: {e}"}
+    return {
+        "success": True,
+        "slow_request": tracer.slow_request,
+        "slow_callback": tracer.slow_callback,
+    }
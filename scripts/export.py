@@ -19,18 +19,101 @@ import asfquart
 import asfquart.auth
 import asfquart.session
 import asfquart.utils
+import asfpy.sqlite
+import asyncio
+import classes
 import quart
 import typing
 import tarfile
-import io
+import tempfile
+import threading
 import time
 
 """Data export end point for ASFMM"""
 
+EXPORT_CHUNK_SIZE = 65536  # Size of the chunks of tar.gz data sent to the client
+EXPORT_QUEUE_SIZE = 16  # Maximum number of chunks waiting to be sent, before the export thread has to wait
+EXPORT_SPOOL_SIZE = 8 * 1024 * 1024  # Files larger than this are spooled to disk while being put together
 
 APP = asfquart.APP
 
 
+class ExportStream:
+    """File-like object for tarfile, passing chunks of output from the export thread to the event loop"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=EXPORT_QUEUE_SIZE)
+        self.buffer = bytearray()
+        self.cancelled = threading.Event()
+
+    def put(self, item):
+        """Hands an item to the event loop, waiting for room in the queue if the client is slow"""
+        if self.cancelled.is_set():
+            raise IOError("Export was cancelled")
+        asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop).result()
+
+    def write(self, data: bytes):
+        self.buffer.extend(data)
+        if len(self.buffer) >= EXPORT_CHUNK_SIZE:
+            self.put(bytes(self.buffer))
+            self.buffer.clear()
+        return len(data)
+
+    def close(self):
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer.clear()
+
+
+def add_file(tar: tarfile.TarFile, name: str, lines: typing.Iterable[str]):
+    """Adds a text file to the tar archive. As the size has to be known up front, it is put together in a
+    temporary file first (kept in memory while small)."""
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE) as spool:
+        for line in lines:
+            spool.write(line.encode("utf-8"))
+        info = tarfile.TarInfo(name=name)
+        info.size = spool.tell()
+        info.mtime = int(time.time())
+        spool.seek(0)
+        tar.addfile(tarinfo=info, fileobj=spool)
+
+
+def chat_log(store: classes.MessageStore, room: str) -> typing.Iterator[str]:
+    """Yields the lines of the chat log for a room, straight from storage"""
+    for message in store.scan(room):
+        for line in message.text.split("\n"):
+            if not line.startswith("[off]"):  # Don't export the off-the-record stuff
+                yield f"[{time.ctime(message.timestamp)}] {message.realname} ({message.sender}): {line}\n"
+
+
+def write_export(stream: ExportStream, db_name: str, store: classes.MessageStore, attendance: list, proxies: list, rooms: list):
+    """Writes the entire export as a tar.gz to the stream. Runs in a separate thread, with its own DB connection."""
+    db = asfpy.sqlite.DB(db_name)
+    try:
+        with tarfile.open(mode="w|gz", fileobj=stream) as tar:
+            # Export attendance
+            add_file(tar, "attendance.txt", ["\n".join(attendance)])
+            # Export proxy attendance (quorum minus in-person attendance)
+            add_file(tar, "proxies-counted.txt", ["\n".join(proxies)])
+            # Export audit log
+            add_file(
+                tar,
+                "auditlog.txt",
+                (f"[{time.ctime(row['timestamp'])}] {row['uid']} {row['action']}\n" for row in db.fetch("auditlog", limit=0)),
+            )
+            # Export chat logs
+            for room in rooms:
+                add_file(tar, f"chat-{room}.txt", chat_log(store, room))
+        stream.close()
+        stream.put(None)  # All done
+    except Exception as e:
+        if not stream.cancelled.is_set():
+            stream.put(e)
+    finally:
+        db.connector.close()
+
+
 @APP.route("/export")
 @asfquart.auth.require()
 async def process_export() -> typing.Any:
@@ -39,51 +122,43 @@ async def process_export() -> typing.Any:
     if whoami.startswith("guest_"):
         return {"success": False, "message": "Guests cannot export data"}
 
-    out = io.BytesIO()
-    tar = tarfile.open(mode="w:gz", fileobj=out)
-
-    # Export attendance
-    attendance = "\n".join(APP.state.quorum.members).encode('utf-8')
-    file = io.BytesIO(attendance)
-    info = tarfile.TarInfo(name="attendance.txt")
-    info.size = len(attendance)
-    tar.addfile(tarinfo=info, fileobj=file)
-
-    # Export proxy attendance (quorum minus in-person attendance)
-    proxy_attendance = "\n".join([x for x in APP.state.quorum.proxies]).encode('utf-8')
-    file = io.BytesIO(proxy_attendance)
-    info = tarfile.TarInfo(name="proxies-counted.txt")
-    info.size = len(proxy_attendance)
-    tar.addfile(tarinfo=info, fileobj=file)
-
-    # Export audit log
-    auditlog = ""
-    for row in APP.state.db.fetch("auditlog", limit=0):
-        auditlog += f"[{time.ctime(row['timestamp'])}] {row ['uid']} {row['action']}\n"
-    auditlog = auditlog.encode('utf-8')
-    file = io.BytesIO(auditlog)
-    info = tarfile.TarInfo(name="auditlog.txt")
-    info.size = len(auditlog)
-    tar.addfile(tarinfo=info, fileobj=file)
-
-    # Export chat logs
-    for room in APP.state.rooms:
-        logfile = ""
-        for message in room.messages:
-            for line in message["message"].split("\n"):
-                if not line.startswith("[off]"):  # Don't export the off-the-record stuff
-                    logfile += f"[{time.ctime(message['timestamp'])}] {message['realname']} ({message['sender']}): {line}\n"
-        logfile = logfile.encode('utf-8')
-        file = io.BytesIO(logfile)
-        info = tarfile.TarInfo(name=f"chat-{room.name}.txt")
-        info.size = len(logfile)
-        tar.addfile(tarinfo=info, fileobj=file)
-
-    # Close up and send
-    tar.close()
+    await APP.state.db_writer.flush()  # Make sure the audit log and chat logs are up to date on disk
+
+    # The export is compressed in a separate thread and streamed to the client as it is produced
+    stream = ExportStream(asyncio.get_running_loop())
+    exporter = threading.Thread(
+        target=write_export,
+        args=(
+            stream,
+            APP.state.config["database"],
+            APP.state.store,
+            APP.state.quorum.members,
+            APP.state.quorum.proxies,
+            list(APP.state.rooms.keys()),
+        ),
+        name="Export",
+        daemon=True,
+    )
+    exporter.start()
+
+    async def send_export():
+        started = time.monotonic()
+        try:
+            while True:
+                chunk = await stream.queue.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:  # Client may have gone away, make sure the export thread doesn't hang around waiting for us
+            stream.cancelled.set()
+            while not stream.queue.empty():
+                stream.queue.get_nowait()
+            APP.state.metrics.observe("asfmm_export_seconds", time.monotonic() - started)
+
     headers = {
         'Content-Disposition': 'attachment; filename=asfmm.tgz',
         "Content-Type": 'application/tgz'
     }
-    response = quart.Response(out.getvalue(), headers=headers)
-    return response
+    return quart.Response(send_export(), headers=headers)
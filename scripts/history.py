@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asfquart
+import asfquart.auth
+import asfquart.session
+import asfquart.utils
+import classes
+import quart
+import typing
+
+"""History paging end point for ASFMM"""
+
+HISTORY_PAGE_SIZE = 100  # Default number of messages per page
+HISTORY_PAGE_MAX = 500  # Maximum number of messages a client can ask for in one go
+
+APP = asfquart.APP
+
+
+@APP.route("/history")
+@asfquart.auth.require()
+async def process_history() -> typing.Any:
+    session = await asfquart.session.read()
+    formdata = await asfquart.utils.formdata()
+    if session.uid in APP.state.moderation.banned:
+        return {"success": False, "message": "You appear to be banned from reading messages"}
+    roomname = formdata.get("room")
+    try:
+        before = float(formdata.get("before", 0)) or None
+        limit = min(HISTORY_PAGE_MAX, max(1, int(formdata.get("limit", HISTORY_PAGE_SIZE))))
+    except ValueError:
+        return {"success": False, "message": "Invalid paging parameters"}
+    room = APP.state.rooms.get(roomname)
+    if room is not None:
+        # Keyset pagination: the client passes the timestamp of the oldest message it has seen. Messages at that
+        # timestamp are included, as others may share it, and the client skips the ones it already has.
+        # Messages come out of storage as encoded frames, so the response is put together from those as-is.
+        frames = room.fetch_frames(before=before, limit=limit)
+        body = '{"success":true,"channel":%s,"history":[%s]}' % (classes.json_encode(room.name), ",".join(frames))
+        return quart.Response(body, content_type="application/json")
+    return {
+        "success": False,
+        "message": "Could not find room!",
+    }
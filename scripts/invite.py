@@ -20,8 +20,6 @@ import asfquart.auth
 import asfquart.generics
 import asfquart.session
 import typing
-import uuid
-import time
 
 """Invitation end point for ASFMM"""
 
@@ -34,21 +32,17 @@ async def process_invite() -> typing.Any:
     formdata = await asfquart.utils.formdata()
     invitee = formdata.get("name")
     sender = session.uid
-    if not invitee or sender.startswith("guest_") or sender in APP.state.banned:
+    if not invitee or sender.startswith("guest_") or sender in APP.state.moderation.banned:
         return {"success": False, "message": "Oops, something went terribly wrong here!"}
 
     realname = session.fullname
 
-    invite_id = str(uuid.uuid4())
-    APP.state.invites[invite_id] = {
-        "timestamp": time.time(),
-        "inviter": sender,
-        "inviter_name": realname,
-        "name": f"{invitee} (Guest)",
-    }
+    invite = await APP.state.invites.create(sender, realname, f"{invitee} (Guest)")
+    if not invite:
+        return {"success": False, "message": f"You can have at most {APP.state.invites.quota} unused invites at a time"}
     return {
         "success": True,
         "message": "Invite created",
-        "url": APP.state.config["oauth"]["asf"]["invite_url"] + invite_id,
+        "url": APP.state.config["oauth"]["asf"]["invite_url"] + invite["code"],
     }
 
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asfquart
+import asfquart.session
+import hmac
+import quart
+import typing
+
+"""Prometheus metrics end point for ASFMM"""
+
+APP = asfquart.APP
+
+LOCAL_ADDRESSES = ("127.0.0.1", "::1")
+
+
+@APP.route("/metrics")
+async def process_metrics() -> typing.Any:
+    # Scrapers can authenticate with the bearer token from mm.yaml, everyone else needs to be an admin.
+    # Requests from localhost are only let through if explicitly allowed, as a reverse proxy makes everything local.
+    config = APP.state.config.get("metrics", {})
+    token = config.get("token")
+    authorization = quart.request.headers.get("Authorization", "").encode("utf-8")
+    scraper = bool(token) and hmac.compare_digest(authorization, f"Bearer {token}".encode("utf-8"))
+    local = config.get("allow_localhost", False) and quart.request.remote_addr in LOCAL_ADDRESSES
+    if not (scraper or local):
+        session = await asfquart.session.read()
+        if not session or session.uid not in APP.state.admins:
+            return quart.Response("You need administrative powers for this...", status=403)
+    return quart.Response(APP.state.metrics.render(), content_type="text/plain; version=0.0.4")
@@ -37,32 +37,32 @@ async def process_mgmt() -> typing.Any:
     action = formdata.get("action")
     if action == "block":
         who = formdata.get("user")
-        if who and who not in APP.state.blocked:
-            APP.state.blocked.append(who)
+        if who:
+            APP.state.moderation.moderate("block", who)
         return {
             "success": True,
             "message": f"User {who} blocked",
         }
     elif action == "ban":
         who = formdata.get("user")
-        if who and who not in APP.state.banned:
-            APP.state.banned.append(who)
+        if who:
+            APP.state.moderation.moderate("ban", who)
         return {
             "success": True,
             "message": f"User {who} banned",
         }
     elif action == "unblock":
         who = formdata.get("user")
-        if who and who in APP.state.blocked:
-            APP.state.blocked.remove(who)
+        if who:
+            APP.state.moderation.moderate("unblock", who)
         return {
             "success": True,
             "message": f"User {who} unblocked",
         }
     elif action == "unban":
         who = formdata.get("user")
-        if who and who in APP.state.banned:
-            APP.state.banned.remove(who)
+        if who:
+            APP.state.moderation.moderate("unban", who)
         return {
             "success": True,
             "message": f"User {who} unbanned",
@@ -70,14 +70,7 @@ async def process_mgmt() -> typing.Any:
     elif action == "redact":
         msgid = formdata.get("msgid")
         if msgid:
-            for room in APP.state.rooms:
-                msg = None
-                for message in room.messages:
-                    if message["uid"] == msgid:
-                        msg = message
-                        break
-                if msg:
-                    room.messages.remove(msg)
+            APP.state.redact(msgid)
         return {
             "success": True,
             "message": f"Message redacted from records",
@@ -43,26 +43,22 @@ async def process_oauth() -> typing.Any:
             session = await asfquart.session.read()
             if session and session.uid in APP.state.members:
                 APP.state.quorum.add(session.uid)
-                APP.state.db.insert("auditlog", {"uid": session.uid, "timestamp": time.time(), "action": f"logged in via ASF OAuth"})
+                APP.state.db_writer.insert("auditlog", {"uid": session.uid, "timestamp": time.time(), "action": f"logged in via ASF OAuth"})
                 return redirect("/")
             else:  # Not a member?!
                 asfquart.session.clear()  # Clear the session on failure
                 return "Only current ASF Members can log in via OAuth. If you are an emeritus member or a guest, please have a current member invite you."
     elif provider == "guest":
         code = formdata.get("code")
-        if code and code in APP.state.invites:
-            guest_prefix = 1
-            for attendee in APP.state.attendees.keys():
-                if attendee.startswith("guest_"):
-                    guest_prefix += 1
+        invite = await APP.state.invites.redeem(code) if code else None
+        if invite:
             new_session = {
-                "uid": "guest_" + str(guest_prefix) + "/" + APP.state.invites[code]["inviter"],
-                "fullname": APP.state.invites[code]["name"],
+                "uid": "guest_" + str(invite["guest_id"]) + "/" + invite["inviter"],
+                "fullname": invite["name"],
                 "provider": "Invite Code",
             }
             asfquart.session.write(new_session)
-            del APP.state.invites[code]
             return redirect("/")
         else:
-            return "Could not find invite code. It may have already been used."
+            return "Could not find invite code. It may have already been used, or have expired."
 
@@ -20,7 +20,6 @@ import asfquart.auth
 import asfquart.session
 import asfquart.utils
 import typing
-import time
 
 """Post end point for MM"""
 
@@ -37,34 +36,4 @@ async def process_post() -> typing.Any:
     if not session:
         return {"success": False, "message": "Oops, something went terribly wrong here!"}
 
-    sender = session.uid
-    realname = session.fullname
-    message = formdata.get("message")
-    roomname = formdata.get("room")
-    if sender in APP.state.blocked or sender in APP.state.banned:
-        return {
-            "success": False,
-            "message": "You appear to be blocked from sending messages",
-        }
-    throttle_max = APP.state.config.get("message_rate_limit", 5)
-    for room in APP.state.rooms:
-        if room.name == roomname:
-            if len(room.flood_control) >= throttle_max and room.flood_control[-throttle_max] >= time.time()-1:
-                return {
-                    "success": False,
-                    "message": "The chat is experiencing a large influx of messages and have been throttled. Please try again.",
-                }
-            room.add_message(sender, realname, message)
-            # Add the timestamp of this message to flood control list
-            room.flood_control.append(time.time())
-            if len(room.flood_control) > 50:
-                room.flood_control.pop(0)
-            return {
-                "success": True,
-                "message": "Message sent!",
-            }
-    return {
-        "success": False,
-        "message": "Could not find room!",
-    }
-
+    return APP.state.post(session.uid, session.fullname, formdata.get("room"), formdata.get("message"))
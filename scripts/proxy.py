@@ -19,6 +19,9 @@ import asfquart
 import asfquart.auth
 import asfquart.session
 import asfquart.utils
+import csv
+import io
+import quart
 import typing
 import time
 
@@ -27,6 +30,41 @@ import time
 APP = asfquart.APP
 
 
+def assign_proxies(whoami: str, members: typing.Iterable[str], uploaded: bool = False) -> dict:
+    """Assigns a batch of proxies, validating all of them in one go, and records it in the audit log.
+    Admins can upload proxy lists on behalf of others, in which case the proxies are not assigned to them."""
+    candidates = set(member for member in members if member)
+    valid = candidates & APP.state.members
+    assigned = APP.state.quorum.add_proxies(valid)
+    invalid = sorted(candidates - valid)
+    already = sorted(valid.difference(assigned))
+    action = f"added the following {len(assigned)} proxies{' from an uploaded list' if uploaded else ''}: {', '.join(assigned)}"
+    message = f"{len(assigned)} proxies assigned{'' if uploaded else ' to you'}: " + ", ".join(assigned)
+    if invalid:
+        action += f". The following {len(invalid)} invalid proxies were present: {', '.join(invalid)}"
+        message += f"\n{len(invalid)} proxies were not members: " + ", ".join(invalid)
+    if already:
+        message += f"\n{len(already)} proxies were already accounted for: " + ", ".join(already)
+    APP.state.db_writer.insert("auditlog", {"uid": whoami, "timestamp": time.time(), "action": action})
+    return {
+        "success": True,
+        "message": message,
+        "assigned": assigned,
+        "invalid": invalid,
+        "already": already,
+    }
+
+
+def parse_proxy_list(text: str) -> typing.List[str]:
+    """Reads member IDs from an uploaded proxy list: either a plain list with one ID per line, or a CSV file
+    with the ID in the first column. Anything after the ID on a line (such as a name) is ignored."""
+    members = []
+    for row in csv.reader(io.StringIO(text)):
+        if row and row[0].strip():
+            members.append(row[0].split()[0])
+    return members
+
+
 @APP.route("/proxy", methods=["POST"])
 @asfquart.auth.require()
 async def process_proxy() -> typing.Any:
@@ -35,24 +73,21 @@ async def process_proxy() -> typing.Any:
     whoami = session.uid
     if whoami.startswith("guest_"):
         return {"success": False, "message": "Guests cannot assign proxies"}
+    return assign_proxies(whoami, formdata.get("members") or [])
 
-    assigned = set()
-    invalid = set()
-    for member in formdata.get("members"):
-        if member and member in APP.state.members:
-            APP.state.quorum.add_proxy(member)
-            assigned.add(member)
-        elif member:
-            invalid.add(member)
-    if not invalid:
-        APP.state.db.insert("auditlog", {"uid": whoami, "timestamp": time.time(), "action": f"added the following {len(assigned)} proxies: {', '.join(list(assigned))}"})
-        return {
-            "success": True,
-            "message": f"{len(assigned)} proxies assigned to you: " + ", ".join(list(assigned))
-        }
-    else:
-        APP.state.db.insert("auditlog", {"uid": whoami, "timestamp": time.time(), "action": f"added the following {len(assigned)} proxies: {', '.join(list(assigned))}. The following {len(invalid)} invalid proxies were present: {', '.join(list(invalid))}"})
-        return {
-            "success": True,
-            "message": f"{len(assigned)} proxies assigned to you: " + ", ".join(list(assigned)) + f"\n{len(invalid)} proxies were invalid or already assigned: " + ", ".join(list(invalid))
-        }
+
+@APP.route("/proxy/upload", methods=["POST"])
+@asfquart.auth.require()
+async def process_proxy_upload() -> typing.Any:
+    session = await asfquart.session.read()
+    if session.uid not in APP.state.admins:
+        return {"success": False, "message": "You need administrative powers for this..."}
+    formdata = await asfquart.utils.formdata()
+    text = formdata.get("text")
+    if not text:
+        files = await quart.request.files
+        if "file" in files:
+            text = files["file"].read().decode("utf-8", errors="replace")
+    if not text:
+        return {"success": False, "message": "No proxy list was uploaded"}
+    return assign_proxies(session.uid, parse_proxy_list(text), uploaded=True)
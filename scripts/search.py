@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import asfquart
+import asfquart.auth
+import asfquart.session
+import asfquart.utils
+import time
+import typing
+
+"""Full-text search end point for ASFMM"""
+
+SEARCH_PAGE_SIZE = 25  # Default number of results per page
+SEARCH_PAGE_MAX = 100  # Maximum number of results a client can ask for in one go
+
+APP = asfquart.APP
+
+
+@APP.route("/search")
+@asfquart.auth.require()
+async def process_search() -> typing.Any:
+    session = await asfquart.session.read()
+    formdata = await asfquart.utils.formdata()
+    if session.uid in APP.state.moderation.banned:
+        return {"success": False, "message": "You appear to be banned from reading messages"}
+    if not APP.state.search.available:
+        return {"success": False, "message": "Search is not available on this server"}
+    query = formdata.get("q", "").strip()
+    if not query:
+        return {"success": False, "message": "Please enter something to search for"}
+    roomname = formdata.get("room") or None
+    if roomname is not None and roomname not in APP.state.rooms:
+        return {"success": False, "message": "Could not find room!"}
+    try:
+        after = float(formdata["after"]) if formdata.get("after") else None
+        before = float(formdata["before"]) if formdata.get("before") else None
+        limit = min(SEARCH_PAGE_MAX, max(1, int(formdata.get("limit", SEARCH_PAGE_SIZE))))
+        page = max(1, int(formdata.get("page", 1)))
+    except ValueError:
+        return {"success": False, "message": "Invalid search parameters"}
+    started = time.monotonic()
+    # Results are ranked rather than in chronological order, so page by offset. Fetch one extra to see if there is more.
+    # Searching a large history takes a while, so it runs in a thread, on a database connection of its own.
+    results = await asyncio.to_thread(
+        APP.state.search.search,
+        query,
+        room=roomname,
+        sender=formdata.get("sender") or None,
+        after=after,
+        before=before,
+        limit=limit + 1,
+        offset=(page - 1) * limit,
+    )
+    APP.state.metrics.observe("asfmm_search_seconds", time.monotonic() - started)
+    return {
+        "success": True,
+        "page": page,
+        "more": len(results) > limit,
+        "results": [{**message.frame(), "score": score} for message, score in results[:limit]],
+    }
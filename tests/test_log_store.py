@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the segmented message log storage backend. Run from the top directory with: python3 -m pytest tests"""
+
+import json
+import os
+import uuid
+import zlib
+
+import classes
+
+
+def segment_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".log"))
+
+
+def fill(log, count, start=1000.0):
+    """Appends count message records to a log, one second apart, with their number as payload"""
+    for number in range(count):
+        log.append(classes.LOG_RECORD_MESSAGE, start + number, number.to_bytes(16, "big"), b"message %04d" % number)
+
+
+def payloads(log):
+    return [payload for _, _, _, payload in log.records()]
+
+
+def test_record_format(tmp_path):
+    log = classes.MessageLog(str(tmp_path))
+    key = uuid.uuid4().bytes
+    log.append(classes.LOG_RECORD_MESSAGE, 1234.5, key, b"hello")
+    log.close()
+    (name,) = segment_files(tmp_path)
+    assert name == "%020d.log" % 0
+    data = (tmp_path / name).read_bytes()
+    length, checksum = classes.LOG_RECORD_PREFIX.unpack_from(data)
+    body = data[classes.LOG_RECORD_PREFIX.size:]
+    assert length == 5
+    assert len(body) == classes.LOG_RECORD_BODY.size + length
+    assert checksum == zlib.crc32(body)
+    assert classes.LOG_RECORD_BODY.unpack_from(body) == (classes.LOG_RECORD_MESSAGE, 1234.5, key)
+    assert body[classes.LOG_RECORD_BODY.size:] == b"hello"
+
+
+def test_reopen_reads_everything(tmp_path):
+    log = classes.MessageLog(str(tmp_path))
+    fill(log, 200)
+    log.close()
+    log = classes.MessageLog(str(tmp_path), writable=False)
+    assert log.count == 200
+    assert [timestamp for timestamp, _, _ in log.read(limit=3)] == [1197.0, 1198.0, 1199.0]
+    assert [payload for _, _, payload in log.read(before=1100.0, limit=2)] == [b"message 0098", b"message 0099", b"message 0100"]
+    log.close()
+
+
+def test_torn_write_is_truncated(tmp_path):
+    log = classes.MessageLog(str(tmp_path))
+    fill(log, 10)
+    log.close()
+    (name,) = segment_files(tmp_path)
+    path = tmp_path / name
+    intact = path.stat().st_size
+    with open(path, "ab") as f:  # The first half of a record, as left by a worker dying mid-write
+        record = classes.LOG_RECORD_PREFIX.pack(100, 0) + classes.LOG_RECORD_BODY.pack(1, 2000.0, bytes(16))
+        f.write(record[:20])
+
+    reader = classes.MessageLog(str(tmp_path), writable=False)  # Readers leave it alone, it may still be written
+    assert reader.count == 10
+    assert path.stat().st_size == intact + 20
+    reader.close()
+
+    log = classes.MessageLog(str(tmp_path))
+    assert path.stat().st_size == intact
+    assert log.count == 10
+    log.append(classes.LOG_RECORD_MESSAGE, 2000.0, bytes(16), b"after recovery")
+    assert payloads(log)[-2:] == [b"message 0009", b"after recovery"]
+    log.close()
+
+
+def test_corrupt_record_is_skipped(tmp_path):
+    log = classes.MessageLog(str(tmp_path), segment_size=500)
+    fill(log, 40)
+    log.close()
+    first = tmp_path / segment_files(tmp_path)[0]
+    data = bytearray(first.read_bytes())
+    record_size = classes.LOG_RECORD_PREFIX.size + classes.LOG_RECORD_BODY.size + len(b"message 0000")
+    data[record_size * 3 + 10] ^= 0xFF  # Damage the fourth record of a sealed segment
+    first.write_bytes(data)
+
+    log = classes.MessageLog(str(tmp_path), writable=False)
+    assert log.count == 39
+    assert b"message 0003" not in payloads(log)
+    assert payloads(log)[-1] == b"message 0039"
+    log.close()
+
+
+def test_segment_rollover(tmp_path):
+    log = classes.MessageLog(str(tmp_path), segment_size=1000)
+    fill(log, 300)
+    names = segment_files(tmp_path)
+    assert len(names) > 1
+    base = 0
+    for name in names:  # Every segment is named after its offset in the log, and only the last one is below size
+        assert int(name[:-4]) == base
+        size = os.path.getsize(tmp_path / name)
+        if name != names[-1]:
+            assert size >= 1000
+        base += size
+    assert payloads(log) == [b"message %04d" % number for number in range(300)]
+    # Pages spanning segment boundaries
+    page = log.read(before=1150.0, limit=100)  # The boundary message, and the 100 before it
+    assert [timestamp for timestamp, _, _ in page] == [1050.0 + number for number in range(101)]
+    log.close()
+
+
+def test_store_redactions_and_frames(tmp_path):
+    store = classes.LogStore(str(tmp_path), segment_size=4096)
+    messages = [classes.Message(str(uuid.uuid4()), 1000.0 + number, "room", "alice", "Alice", f"hello {number}") for number in range(5)]
+    for message in messages:
+        store.append(message)
+    store.redact(messages[1].msgid)
+    assert [message.text for message in store.fetch("room")] == ["hello 0", "hello 2", "hello 3", "hello 4"]
+    timestamp, key, frame = store.frames("room", limit=1)[0]
+    assert timestamp == 1004.0
+    assert key == classes.message_key(messages[4].msgid)
+    assert json.loads(frame) == messages[4].frame()
+    assert store.rooms() == ["room"]
+    store.close()
+    store = classes.LogStore(str(tmp_path), writable=False)
+    assert [message.msgid for message in store.scan("room")] == [messages[number].msgid for number in (0, 2, 3, 4)]
+    store.close()
+
+
+def test_store_appends_on_writer_thread(tmp_path):
+    db_writer = classes.DBWriter(str(tmp_path / "asfmm.sqlite"))
+    store = classes.LogStore(str(tmp_path / "messages"), db_writer=db_writer)
+    message = classes.Message(str(uuid.uuid4()), 1000.0, "room", "alice", "Alice", "hello")
+    store.append(message)
+    db_writer.close()  # Waits for everything queued to be written
+    assert [stored.msgid for stored in store.fetch("room")] == [message.msgid]
+    store.close()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for refreshing the member roster over HTTP. Run from the top directory with: python3 -m pytest tests"""
+
+import asyncio
+import json
+
+import aiohttp
+import aiohttp.web
+import pytest
+
+import classes
+
+ETAG = '"v1"'
+LAST_MODIFIED = "Sat, 17 Oct 2026 12:00:00 GMT"
+
+
+def with_roster_server(test, members=("alice", "bob"), status=200):
+    """Runs test(url, requests) against a stub member roster server, which answers with the given status, and
+    with 304 Not Modified to requests carrying its ETag. requests is the list of headers of all requests made."""
+    requests = []
+
+    async def handler(request):
+        requests.append(dict(request.headers))
+        if request.headers.get("If-None-Match") == ETAG:
+            return aiohttp.web.Response(status=304)
+        if status != 200:
+            return aiohttp.web.Response(status=status)
+        return aiohttp.web.json_response({"members": list(members)}, headers={"ETag": ETAG, "Last-Modified": LAST_MODIFIED})
+
+    async def run():
+        app = aiohttp.web.Application()
+        app.router.add_get("/members.json", handler)
+        runner = aiohttp.web.AppRunner(app)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        try:
+            host, port = runner.addresses[0][:2]
+            await test(f"http://{host}:{port}/members.json", requests)
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_refresh_is_conditional(tmp_path):
+    cache_file = str(tmp_path / "members.json")
+
+    async def test(url, requests):
+        roster = classes.Roster(url, cache_file, 3600)
+        assert roster.members == frozenset()
+        assert await roster.refresh() is True
+        assert roster.members == {"alice", "bob"}
+        assert roster.etag == ETAG
+        assert "If-None-Match" not in requests[0]
+        assert await roster.refresh() is False  # Not modified, so nothing changes
+        assert requests[1]["If-None-Match"] == ETAG
+        assert requests[1]["If-Modified-Since"] == LAST_MODIFIED
+        assert roster.members == {"alice", "bob"}
+
+    with_roster_server(test)
+
+
+def test_cache_is_written_and_reloaded(tmp_path):
+    cache_file = str(tmp_path / "members.json")
+
+    async def test(url, requests):
+        await classes.Roster(url, cache_file, 3600).refresh()
+        with open(cache_file) as f:
+            assert json.load(f) == {"members": ["alice", "bob"], "etag": ETAG, "last_modified": LAST_MODIFIED}
+        assert not (tmp_path / "members.json.tmp").exists()
+        roster = classes.Roster(url, cache_file, 3600)  # As after a restart
+        assert roster.members == {"alice", "bob"}
+        assert await roster.refresh() is False  # Picks up where the cache left off
+        assert requests[-1]["If-None-Match"] == ETAG
+
+    with_roster_server(test)
+
+
+def test_cached_roster_is_kept_when_the_server_fails(tmp_path):
+    cache_file = tmp_path / "members.json"
+    cache_file.write_text(json.dumps({"members": ["carol"], "etag": '"v0"', "last_modified": None}))
+
+    async def test(url, requests):
+        roster = classes.Roster(url, str(cache_file), 3600)
+        with pytest.raises(aiohttp.ClientResponseError):
+            await roster.refresh()
+        assert roster.members == {"carol"}
+        assert roster.etag == '"v0"'
+
+    with_roster_server(test, status=503)
+
+
+def test_corrupt_cache_falls_back_to_a_full_fetch(tmp_path):
+    cache_file = tmp_path / "members.json"
+    cache_file.write_text('{"members": ["alice", "bo')  # Cut short
+
+    async def test(url, requests):
+        roster = classes.Roster(url, str(cache_file), 3600)
+        assert roster.members == frozenset()
+        assert roster.etag is None
+        assert await roster.refresh() is True
+        assert "If-None-Match" not in requests[0]
+        assert roster.members == {"alice", "bob"}
+        assert json.loads(cache_file.read_text())["members"] == ["alice", "bob"]  # Replaced by a good copy
+
+    with_roster_server(test)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Converts the chat messages of ASFMM between storage backends.
+
+Copies every message from the SQLite database to segmented message logs, or the other way around, leaving the source
+as it is. Redacted messages are not copied. Stop the service first, then switch the storage backend in mm.yaml once
+the conversion is done:
+
+    python3 tools/convert_store.py --to log --database asfmm.sqlite --path messages
+    python3 tools/convert_store.py --to sqlite --database asfmm.sqlite --path messages
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import asfpy.sqlite  # noqa: E402
+import classes  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert ASFMM chat messages between storage backends")
+    parser.add_argument("--to", choices=("log", "sqlite"), required=True, help="Backend to convert to")
+    parser.add_argument("--database", default="asfmm.sqlite", help="SQLite database (default: asfmm.sqlite)")
+    parser.add_argument("--path", default="messages", help="Directory of the message logs (default: messages)")
+    parser.add_argument("--segment-size", type=int, default=classes.DEFAULT_SEGMENT_SIZE, help="Size of log segments, in bytes")
+    args = parser.parse_args()
+
+    db = asfpy.sqlite.DB(args.database)
+    db_writer = classes.DBWriter(args.database)
+    sqlite_store = classes.SQLiteStore(db, db_writer, args.database)
+    log_store = classes.LogStore(args.path, args.segment_size, writable=args.to == "log")
+    source, target = (sqlite_store, log_store) if args.to == "log" else (log_store, sqlite_store)
+
+    started = time.monotonic()
+    total = 0
+    try:
+        rooms = source.rooms()
+        for room in rooms:
+            if target.fetch(room, limit=1):
+                parser.error(f"There are already messages for #{room} in the target, not converting")
+        for room in rooms:
+            count = 0
+            for message in source.scan(room):
+                target.append(message)
+                count += 1
+            print(f"Copied {count} message(s) from #{room}")
+            total += count
+    finally:
+        db_writer.close()
+        log_store.close()
+    print(f"Copied {total} message(s) in {time.monotonic() - started:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rebuilds the full-text search index of an ASFMM database offline.
+
+The service builds the index by itself when it first starts on a database without one, and keeps it up to date from
+then on. Use this to (re)build it while the service is stopped, for instance on a copy of a database from an earlier
+meeting, or after a VACUUM (which may renumber the rows the index refers to):
+
+    python3 tools/rebuild_search.py asfmm.sqlite
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import classes  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the full-text search index of an ASFMM database")
+    parser.add_argument("database", help="Path to the SQLite database, e.g. asfmm.sqlite")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.database):
+        parser.error(f"No such database: {args.database}")
+    connector = sqlite3.connect(args.database)
+    (messages,) = connector.execute("SELECT COUNT(*) FROM messages").fetchone()
+    started = time.monotonic()
+    classes.SearchIndex.create(connector, rebuild=True)
+    connector.execute("""INSERT INTO "messages_search" ("messages_search") VALUES ('optimize');""")
+    connector.commit()
+    print(f"Indexed {messages} message(s) in {time.monotonic() - started:.2f}s")
+    connector.close()
+
+
+if __name__ == "__main__":
+    main()